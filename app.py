@@ -1,20 +1,35 @@
 # appy.py
 
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, Response, stream_with_context, make_response, abort
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
 from dotenv import load_dotenv
 import qrcode
 from io import BytesIO
 import base64
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import re
+import bisect
+import hashlib
+import codecs
+import itertools
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import threading
+import queue
+import time
+import uuid
 import ssl
 import sys
 from flask_migrate import Migrate
 import warnings
-from sqlalchemy.exc import SAWarning
+from sqlalchemy.exc import SAWarning, IntegrityError, SQLAlchemyError
 
 # Configuração SSL
 SSL_CERT_PATH = 'ssl_certs/server.crt'
@@ -82,6 +97,14 @@ class OrdemProducao(db.Model):
     sincronizado_em = db.Column(db.DateTime)
     observacao = db.Column(db.Text)
     origem_api = db.Column(db.Boolean, default=False)
+    hash_erp = db.Column(db.String(64))
+    
+    __table_args__ = (
+        # Cobre a lista de OPs da máquina: igualdade em maquina_atual, faixa em op e
+        # os filtros de status/saldo resolvidos sem ler a linha da tabela
+        db.Index('ix_ordens_producao_selecao', 'maquina_atual', 'op', 'status_op',
+                 'qtde_produzida', 'qtde_carregado'),
+    )
     
     # Relacionamentos corrigidos
     apontamentos = db.relationship('Apontamento', backref='op_rel', lazy=True, overlaps="apontamentos_rel")
@@ -137,11 +160,56 @@ class LogSincronizacao(db.Model):
     registros_processados = db.Column(db.Integer, default=0)
     registros_novos = db.Column(db.Integer, default=0)
     registros_atualizados = db.Column(db.Integer, default=0)
+    registros_inalterados = db.Column(db.Integer, default=0)
     duracao_segundos = db.Column(db.Float)
     status = db.Column(db.String(20))
     mensagem = db.Column(db.Text)
     detalhes = db.Column(db.Text)
 
+class TokenAPI(db.Model):
+    __tablename__ = 'tokens_api'
+    id = db.Column(db.Integer, primary_key=True)
+    chave = db.Column(db.String(255), unique=True, nullable=False)
+    access_token = db.Column(db.Text)
+    expira_em = db.Column(db.DateTime)
+    atualizado_em = db.Column(db.DateTime, default=datetime.utcnow)
+
+class MarcaSincronizacao(db.Model):
+    __tablename__ = 'marcas_sincronizacao'
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), unique=True, nullable=False)
+    marca = db.Column(db.DateTime, nullable=False)
+    atualizado_em = db.Column(db.DateTime, default=datetime.utcnow)
+
+class TravaSistema(db.Model):
+    __tablename__ = 'travas_sistema'
+    id = db.Column(db.Integer, primary_key=True)
+    nome = db.Column(db.String(255), unique=True, nullable=False)
+    dono = db.Column(db.String(64))
+    expira_em = db.Column(db.DateTime)
+
+class JobSincronizacao(db.Model):
+    __tablename__ = 'jobs_sincronizacao'
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(50), nullable=False, default='ops')
+    origem = db.Column(db.String(20), nullable=False, default='manual')
+    status = db.Column(db.String(20), nullable=False, default='pendente')
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+    iniciado_em = db.Column(db.DateTime)
+    finalizado_em = db.Column(db.DateTime)
+    mensagem = db.Column(db.Text)
+    resultado = db.Column(db.Text)
+    progresso = db.Column(db.Text)
+
+class RequisicaoIdempotente(db.Model):
+    __tablename__ = 'requisicoes_idempotentes'
+    id = db.Column(db.Integer, primary_key=True)
+    chave = db.Column(db.String(64), unique=True, nullable=False)
+    operacao = db.Column(db.String(30), nullable=False)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'))
+    resposta = db.Column(db.Text, nullable=False)
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+
 
 # ========== CONTEXT PROCESSOR ==========
 @app.context_processor
@@ -149,6 +217,92 @@ def inject_datetime():
     """Injeta datetime e now em todos os templates"""
     return dict(datetime=datetime, now=datetime.utcnow)
 
+@app.context_processor
+def inject_qr_versao():
+    """Versão do conteúdo dos QR Codes, usada nas URLs /qr/v<versão>/... montadas em JavaScript"""
+    return dict(qr_payload_versao=QR_PAYLOAD_VERSAO)
+
+
+# LIKE do SQLite: maiúsculas/minúsculas só se equivalem no ASCII
+_ASCII_MINUSCULAS = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+class MaquinaResolver:
+    """Resolve códigos de máquina vindos do ERP sem consultar o banco por OP"""
+    
+    def __init__(self, maquinas):
+        self.por_codigo = {}
+        self.por_codigo_qr = {}
+        self.contadores = {'codigo': 0, 'codigo_qr': 0, 'prefixo': 0, 'nao_encontrada': 0, 'sem_codigo': 0}
+        
+        # Em caso de códigos repetidos prevalece a máquina de menor ID (mesmo resultado do .first())
+        for maquina_id, codigo, codigo_qr in sorted(maquinas):
+            self.por_codigo.setdefault(codigo, maquina_id)
+            self.por_codigo_qr.setdefault(codigo_qr, maquina_id)
+        
+        # Índice ordenado para a busca por prefixo, com as mesmas regras do LIKE 'TING.001%'
+        # no SQLite: letras ASCII sem distinção de caixa e '_'/'%' como curingas
+        self.codigos_ordenados = sorted(
+            (codigo.translate(_ASCII_MINUSCULAS), maquina_id) for codigo, maquina_id in self.por_codigo.items()
+        )
+    
+    @classmethod
+    def from_database(cls):
+        """Carrega todas as máquinas em uma única consulta"""
+        rows = db.session.query(Maquina.id, Maquina.codigo, Maquina.codigo_qr).all()
+        return cls([(row.id, row.codigo, row.codigo_qr) for row in rows])
+    
+    def resolve(self, codigo_maquina):
+        """Retorna o ID da máquina pelo código, código QR ou prefixo do código"""
+        if not codigo_maquina or codigo_maquina.strip() == '':
+            self.contadores['sem_codigo'] += 1
+            return None
+        
+        codigo = codigo_maquina.strip()
+        
+        # Tentar encontrar máquina pelo código
+        if codigo in self.por_codigo:
+            self.contadores['codigo'] += 1
+            return self.por_codigo[codigo]
+        
+        # Se não encontrar, tentar pelo código QR
+        if codigo in self.por_codigo_qr:
+            self.contadores['codigo_qr'] += 1
+            return self.por_codigo_qr[codigo]
+        
+        # Se ainda não encontrar, tentar encontrar por parte do código
+        if '.' in codigo_maquina:
+            # Extrair parte principal do código (ex: TING.001.00001 -> TING.001)
+            parts = codigo_maquina.split('.')
+            if len(parts) >= 2:
+                maquina_id = self._find_by_prefix(f"{parts[0]}.{parts[1]}")
+                if maquina_id is not None:
+                    self.contadores['prefixo'] += 1
+                    return maquina_id
+        
+        self.contadores['nao_encontrada'] += 1
+        return None
+    
+    def _find_by_prefix(self, prefixo):
+        """Busca binária no índice ordenado; retorna o menor ID entre os códigos com o prefixo"""
+        prefixo = prefixo.translate(_ASCII_MINUSCULAS)
+        
+        # Curingas no próprio código (raro): varredura com a expressão equivalente ao LIKE
+        if '_' in prefixo or '%' in prefixo:
+            padrao = re.compile(''.join(
+                '.' if c == '_' else '.*' if c == '%' else re.escape(c) for c in prefixo
+            ), re.DOTALL)
+            candidatos = [maquina_id for codigo, maquina_id in self.codigos_ordenados if padrao.match(codigo)]
+            return min(candidatos) if candidatos else None
+        
+        inicio = bisect.bisect_left(self.codigos_ordenados, (prefixo,))
+        candidatos = []
+        
+        for codigo, maquina_id in self.codigos_ordenados[inicio:]:
+            if not codigo.startswith(prefixo):
+                break
+            candidatos.append(maquina_id)
+        
+        return min(candidatos) if candidatos else None
 
 # ========== CLIENTE API SYSTÊXTIL ==========
 
@@ -160,6 +314,37 @@ class SystextilAPIClient:
         self.client_secret = os.getenv('SYSTEXTIL_CLIENT_SECRET', 'v6CnE7I6vI6JkYn7DOIQ6A..')
         self.access_token = None
         self.token_expiry = None
+        self.batch_size = int(os.getenv('SYSTEXTIL_SYNC_BATCH_SIZE', 500))
+        
+        # Cada lote de OPs é gravado e confirmado (commit) separadamente
+        self.commit_size = int(os.getenv('SYSTEXTIL_SYNC_COMMIT_SIZE', self.batch_size))
+        
+        # Sincronização incremental: filtro enviado ao ERP e campo com a data de alteração da OP
+        self.delta_param = os.getenv('SYSTEXTIL_DELTA_PARAM', 'data_inicio')
+        self.delta_format = os.getenv('SYSTEXTIL_DELTA_FORMAT', '%Y-%m-%d')
+        self.delta_overlap = timedelta(minutes=int(os.getenv('SYSTEXTIL_DELTA_OVERLAP_MINUTES', 10)))
+        self.watermark_field = os.getenv('SYSTEXTIL_WATERMARK_FIELD')
+        
+        # Paginação ORDS (offset/limit/hasMore): tamanho de página opcional e páginas buscadas em paralelo
+        self.page_size = int(os.getenv('SYSTEXTIL_PAGE_SIZE', 0)) or None
+        self.page_workers = max(1, int(os.getenv('SYSTEXTIL_PAGE_WORKERS', 4)))
+        
+        # Token é renovado alguns segundos antes de expirar
+        self.token_margin = timedelta(seconds=int(os.getenv('SYSTEXTIL_TOKEN_MARGIN_SECONDS', 60)))
+        self.token_cache_key = f"{self.token_url}|{self.client_id}"
+        self._token_lock = threading.Lock()
+        
+        # Sessão HTTP com pool de conexões keep-alive
+        pool_size = int(os.getenv('SYSTEXTIL_HTTP_POOL_SIZE', 10))
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                              allowed_methods=frozenset(['GET']))
+        )
+        self.http = requests.Session()
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
     
     def _get_access_token(self):
         """Obtém token OAuth2 usando client credentials"""
@@ -176,12 +361,13 @@ class SystextilAPIClient:
         }
         
         try:
-            response = requests.post(self.token_url, headers=headers, data=data, timeout=30)
+            response = self.http.post(self.token_url, headers=headers, data=data, timeout=30)
             
             if response.status_code == 200:
                 token_data = response.json()
                 self.access_token = token_data['access_token']
                 self.token_expiry = datetime.utcnow() + timedelta(seconds=token_data.get('expires_in', 3600))
+                self._store_cached_token()
                 return True
             else:
                 raise Exception(f"Erro ao obter token: {response.status_code} - {response.text}")
@@ -190,15 +376,173 @@ class SystextilAPIClient:
     
     def _ensure_token_valid(self):
         """Verifica se o token é válido e renova se necessário"""
-        if not self.access_token or not self.token_expiry or datetime.utcnow() >= self.token_expiry:
-            return self._get_access_token()
-        return True
+        with self._token_lock:
+            if self._token_is_fresh(self.access_token, self.token_expiry):
+                return True
+            return self._load_or_fetch_token()
+    
+    def _token_is_fresh(self, access_token, expiry):
+        return bool(access_token and expiry and datetime.utcnow() < expiry - self.token_margin)
+    
+    def _invalidate_token(self):
+        """Descarta o token atual (ex: após um 401), localmente e no cache compartilhado"""
+        with self._token_lock:
+            self.access_token = None
+            self.token_expiry = None
+            tabela = TokenAPI.__table__
+            with db.engine.begin() as conn:
+                conn.execute(tabela.update().where(tabela.c.chave == self.token_cache_key).values(
+                    access_token=None, expira_em=None))
+    
+    def _load_or_fetch_token(self):
+        """Reaproveita o token do cache compartilhado entre workers ou busca um novo.
+        
+        Apenas o processo que obtiver a trava do token chama o endpoint OAuth;
+        os demais aguardam o token aparecer no cache.
+        """
+        tabela = TokenAPI.__table__
+        trava = f"token:{self.token_cache_key}"
+        dono = uuid.uuid4().hex
+        limite = datetime.utcnow() + timedelta(seconds=30)
+        
+        while True:
+            with db.engine.connect() as conn:
+                cache = conn.execute(
+                    tabela.select().where(tabela.c.chave == self.token_cache_key)
+                ).first()
+            
+            if cache and self._token_is_fresh(cache.access_token, cache.expira_em):
+                self.access_token = cache.access_token
+                self.token_expiry = cache.expira_em
+                return True
+            
+            if acquire_lock(trava, dono, 30) or datetime.utcnow() >= limite:
+                try:
+                    return self._get_access_token()
+                finally:
+                    release_lock(trava, dono)
+            
+            time.sleep(0.5)
+    
+    def _store_cached_token(self):
+        """Grava o token no cache compartilhado para os demais workers"""
+        tabela = TokenAPI.__table__
+        valores = {
+            'access_token': self.access_token,
+            'expira_em': self.token_expiry,
+            'atualizado_em': datetime.utcnow()
+        }
+        
+        with db.engine.begin() as conn:
+            result = conn.execute(
+                tabela.update().where(tabela.c.chave == self.token_cache_key).values(**valores)
+            )
+            if result.rowcount == 0:
+                conn.execute(tabela.insert().values(chave=self.token_cache_key, **valores))
     
     def get_production_orders(self, ultima_sincronizacao=None):
         """Busca ordens de produção do endpoint api_pcp_ops"""
+        return list(self.iter_production_orders(ultima_sincronizacao))
+    
+    def iter_production_orders(self, ultima_sincronizacao=None, paginas=None, falhas=None):
+        """Busca ordens de produção do endpoint api_pcp_ops em modo streaming.
+        
+        A primeira página é lida com stream=True e os itens são decodificados e normalizados
+        um a um. Se o ORDS indicar hasMore, as páginas seguintes são buscadas em paralelo
+        (até page_workers por vez) e entregues na ordem dos offsets. Cada página lida é
+        registrada em `paginas` com o número de itens e a latência da requisição.
+        
+        Com `falhas` informada, itens malformados (ex: OP não numérica) são registrados
+        nela e pulados em vez de interromper a leitura.
+        """
         if not self._ensure_token_valid():
             raise Exception("Não foi possível obter token de acesso")
         
+        params = {}
+        if ultima_sincronizacao:
+            # Formatar data para a API (SYSTEXTIL_DELTA_FORMAT, ex: '%Y-%m-%dT%H:%M:%S' se o ERP aceitar)
+            params[self.delta_param] = ultima_sincronizacao.strftime(self.delta_format)
+        if self.page_size:
+            params['limit'] = self.page_size
+        
+        if paginas is None:
+            paginas = []
+        
+        try:
+            # Primeira página: lida em streaming
+            response = self._request_ops_page(params)
+            quantidade = 0
+            try:
+                itens = JSONArrayStream(response.iter_content(chunk_size=64 * 1024), 'items')
+                for item in itens:
+                    quantidade += 1
+                    order = self._normalize_or_skip(item, falhas)
+                    if order is not None:
+                        yield order
+            finally:
+                response.close()
+            
+            metadados = itens.metadados
+            paginas.append(self._page_info(0, metadados.get('offset', 0), quantidade, response))
+            
+            # Verificar se a resposta tem o formato correto
+            if not itens.campo_encontrado:
+                print(f"Resposta inesperada da API: {metadados}")
+                return
+            
+            if not metadados.get('hasMore') or quantidade == 0:
+                return
+            
+            # Demais páginas: buscadas em paralelo e consumidas na ordem
+            limite = metadados.get('limit') or quantidade
+            proximo_offset = metadados.get('offset', 0) + limite
+            numero_pagina = 1
+            
+            # Só pede páginas que existem: com totalResults o fim é conhecido; sem ele a
+            # janela de páginas adiantadas começa em uma e dobra a cada página cheia, e
+            # nada novo é pedido depois que uma página chega sem hasMore
+            total = metadados.get('totalResults')
+            janela = self.page_workers if total is not None else 1
+            
+            with ThreadPoolExecutor(max_workers=self.page_workers) as pool:
+                pendentes = deque()
+                try:
+                    while True:
+                        fim_visto = any(
+                            futuro.done() and not futuro.exception() and not futuro.result()[1].get('hasMore')
+                            for futuro in pendentes
+                        )
+                        while (not fim_visto and len(pendentes) < janela
+                               and (total is None or proximo_offset < total)):
+                            pendentes.append(pool.submit(self._fetch_ops_page, params, proximo_offset, limite))
+                            proximo_offset += limite
+                        
+                        if not pendentes:
+                            break
+                        
+                        pagina_itens, metadados, response = pendentes.popleft().result()
+                        paginas.append(self._page_info(numero_pagina, metadados.get('offset'), len(pagina_itens), response))
+                        numero_pagina += 1
+                        
+                        for item in pagina_itens:
+                            order = self._normalize_or_skip(item, falhas)
+                            if order is not None:
+                                yield order
+                        
+                        if not metadados.get('hasMore') or not pagina_itens:
+                            break
+                        
+                        janela = min(janela * 2, self.page_workers)
+                finally:
+                    # Páginas além da última não são necessárias
+                    for futuro in pendentes:
+                        futuro.cancel()
+                
+        except Exception as e:
+            raise Exception(f"Falha na comunicação com API de OPs: {str(e)}")
+    
+    def _request_ops_page(self, params, renovar_token=True):
+        """Faz o GET de uma página de OPs (stream=True) e retorna a resposta com status 200"""
         endpoint = f"{self.base_url}/systextil-intg-plm/api_pcp_ops"
         
         headers = {
@@ -206,172 +550,222 @@ class SystextilAPIClient:
             'Content-Type': 'application/json'
         }
         
-        params = {}
-        if ultima_sincronizacao:
-            # Formatar data para a API (se necessário)
-            params['data_inicio'] = ultima_sincronizacao.strftime('%Y-%m-%d')
+        response = self.http.get(endpoint, headers=headers, params=params, timeout=60, stream=True)
         
-        try:
-            response = requests.get(endpoint, headers=headers, params=params, timeout=60)
-            
-            if response.status_code == 200:
-                data = response.json()
-                
-                # Processa os dados conforme estrutura fornecida
-                processed_orders = []
-                
-                # Verificar se a resposta tem o formato correto
-                if 'items' not in data:
-                    print(f"Resposta inesperada da API: {data}")
-                    return processed_orders
-                
-                for item in data['items']:
-                    # Extrair máquina do nome da máquina se necessário
-                    maquina_op = item.get('MAQUINA_OP', '')
-                    
-                    # Se MAQUINA_OP estiver vazio, tenta extrair do MAQUINA_OP_NOME
-                    if not maquina_op and 'MAQUINA_OP_NOME' in item:
-                        maquina_nome = item['MAQUINA_OP_NOME']
-                        # Tenta extrair código da máquina do nome
-                        if '.' in maquina_nome:
-                            parts = maquina_nome.split('.')
-                            if len(parts) >= 3:
-                                maquina_op = parts[1]  # Segundo item geralmente é o código
-                    
-                    # Garantir que valores numéricos sejam tratados corretamente
-                    try:
-                        qtde_programado = float(item.get('QTDE_PROGRAMADO', 0))
-                    except (ValueError, TypeError):
-                        qtde_programado = 0
-                    
-                    try:
-                        qtde_carregado = float(item.get('QTDE_CARREGADO', 0))
-                    except (ValueError, TypeError):
-                        qtde_carregado = 0
-                    
-                    try:
-                        qtde_produzida = float(item.get('QTDE_PRODUZIDA', 0))
-                    except (ValueError, TypeError):
-                        qtde_produzida = 0
-                    
-                    order = {
-                        'op': int(item.get('OP', 0)),
-                        'produto': item.get('PRODUTO', ''),
-                        'narrativa': item.get('NARRATIVA', ''),
-                        'grupo': item.get('GRUPO', ''),
-                        'qtde_programado': qtde_programado,
-                        'qtde_carregado': qtde_carregado,
-                        'qtde_produzida': qtde_produzida,
-                        'estagio_atual': item.get('ESTAGIO', ''),
-                        'estagio_posicao': item.get('ESTAGIO_POSICAO', ''),
-                        'maquina_op': maquina_op,
-                        'maquina_op_nome': item.get('MAQUINA_OP_NOME', ''),
-                        'deposito_final': item.get('DEPOSITO_FINAL', ''),
-                        'qualidade_tecido': item.get('QUALIDADE_TECIDO', ''),
-                        'metros_1_qualidade': float(item.get('QTDE_METROS_1_QUALIDADE', 0)),
-                        'metros_2_qualidade': float(item.get('QTDE_METROS_2_QUALIDADE', 0)),
-                        'calculado_quebra': float(item.get('CALCULO_QUEBRA', 0)),
-                        'rolos_gerados': int(item.get('QTDE_ROLOS_GERADOS', 0)),
-                        'pecas_vinculadas': item.get('PECAS_VINCULADAS', ''),
-                        'observacao': item.get('OBS', ''),
-                        'periodo': int(item.get('PERIODO', 0)),
-                        'processo': int(item.get('PROCESSO', 0)),
-                        'unidade_medida': item.get('UM', 'M'),
-                        'nivel': item.get('NIVEL', ''),
-                        'subgrupo': item.get('SUB', ''),
-                        'item': item.get('ITEM', '')
-                    }
-                    processed_orders.append(order)
-                
-                return processed_orders
-            else:
+        # Token revogado ou expirado antes do previsto: renova e tenta uma vez mais
+        if response.status_code == 401 and renovar_token:
+            response.close()
+            self._invalidate_token()
+            self._ensure_token_valid()
+            headers['Authorization'] = f'Bearer {self.access_token}'
+            response = self.http.get(endpoint, headers=headers, params=params, timeout=60, stream=True)
+        
+        if response.status_code != 200:
+            try:
                 raise Exception(f"Erro API: {response.status_code} - {response.text}")
-                
+            finally:
+                response.close()
+        
+        return response
+    
+    def _fetch_ops_page(self, params, offset, limite):
+        """Baixa e decodifica uma página inteira (executado nas threads do pool)"""
+        # Sem contexto da aplicação nas threads: um 401 aqui não renova o token no banco
+        response = self._request_ops_page(dict(params, offset=offset, limit=limite), renovar_token=False)
+        try:
+            itens = JSONArrayStream(response.iter_content(chunk_size=64 * 1024), 'items')
+            return list(itens), itens.metadados, response
+        finally:
+            response.close()
+    
+    def _page_info(self, numero, offset, quantidade, response):
+        return {
+            'pagina': numero,
+            'offset': offset,
+            'itens': quantidade,
+            'latencia_ms': round(response.elapsed.total_seconds() * 1000, 1)
+        }
+    
+    def _normalize_or_skip(self, item, falhas):
+        """Normaliza o item; se ele vier malformado, registra em `falhas` e retorna None"""
+        try:
+            return self._normalize_order(item)
         except Exception as e:
-            raise Exception(f"Falha na comunicação com API de OPs: {str(e)}")
+            if falhas is None:
+                raise
+            alterado_em = (
+                self._parse_erp_datetime(item.get(self.watermark_field))
+                if self.watermark_field and isinstance(item, dict) else None
+            )
+            falhas.append({
+                'op': item.get('OP') if isinstance(item, dict) else None,
+                'operacao': 'leitura',
+                'erro': f"Item inválido: {e}",
+                'alterado_em': alterado_em.isoformat() if alterado_em else None
+            })
+            return None
+    
+    def _normalize_order(self, item):
+        """Converte um item do api_pcp_ops para o formato usado na sincronização"""
+        # Extrair máquina do nome da máquina se necessário
+        maquina_op = item.get('MAQUINA_OP', '')
+        
+        # Se MAQUINA_OP estiver vazio, tenta extrair do MAQUINA_OP_NOME
+        if not maquina_op and 'MAQUINA_OP_NOME' in item:
+            maquina_nome = item['MAQUINA_OP_NOME']
+            # Tenta extrair código da máquina do nome
+            if '.' in maquina_nome:
+                parts = maquina_nome.split('.')
+                if len(parts) >= 3:
+                    maquina_op = parts[1]  # Segundo item geralmente é o código
+        
+        # Garantir que valores numéricos sejam tratados corretamente
+        try:
+            qtde_programado = float(item.get('QTDE_PROGRAMADO', 0))
+        except (ValueError, TypeError):
+            qtde_programado = 0
+        
+        try:
+            qtde_carregado = float(item.get('QTDE_CARREGADO', 0))
+        except (ValueError, TypeError):
+            qtde_carregado = 0
+        
+        try:
+            qtde_produzida = float(item.get('QTDE_PRODUZIDA', 0))
+        except (ValueError, TypeError):
+            qtde_produzida = 0
+        
+        order = {
+            'op': int(item.get('OP', 0)),
+            'produto': item.get('PRODUTO', ''),
+            'narrativa': item.get('NARRATIVA', ''),
+            'grupo': item.get('GRUPO', ''),
+            'qtde_programado': qtde_programado,
+            'qtde_carregado': qtde_carregado,
+            'qtde_produzida': qtde_produzida,
+            'estagio_atual': item.get('ESTAGIO', ''),
+            'estagio_posicao': item.get('ESTAGIO_POSICAO', ''),
+            'maquina_op': maquina_op,
+            'maquina_op_nome': item.get('MAQUINA_OP_NOME', ''),
+            'deposito_final': item.get('DEPOSITO_FINAL', ''),
+            'qualidade_tecido': item.get('QUALIDADE_TECIDO', ''),
+            'metros_1_qualidade': float(item.get('QTDE_METROS_1_QUALIDADE', 0)),
+            'metros_2_qualidade': float(item.get('QTDE_METROS_2_QUALIDADE', 0)),
+            'calculado_quebra': float(item.get('CALCULO_QUEBRA', 0)),
+            'rolos_gerados': int(item.get('QTDE_ROLOS_GERADOS', 0)),
+            'pecas_vinculadas': item.get('PECAS_VINCULADAS', ''),
+            'observacao': item.get('OBS', ''),
+            'periodo': int(item.get('PERIODO', 0)),
+            'processo': int(item.get('PROCESSO', 0)),
+            'unidade_medida': item.get('UM', 'M'),
+            'nivel': item.get('NIVEL', ''),
+            'subgrupo': item.get('SUB', ''),
+            'item': item.get('ITEM', ''),
+            'alterado_em': self._parse_erp_datetime(item.get(self.watermark_field)) if self.watermark_field else None
+        }
+        return order
     
-    def sync_orders_to_database(self):
-        """Sincroniza ordens da API para o banco local"""
+    def sync_orders_to_database(self, progresso=None):
+        """Sincroniza ordens da API para o banco local.
+        
+        As OPs são gravadas e confirmadas em lotes de commit_size, para que a sincronização
+        não segure travas no banco durante toda a execução. Falhas de gravação ficam isoladas
+        em savepoints e são registradas em LogSincronizacao.detalhes.
+        
+        Se informado, `progresso` é chamado após cada lote confirmado com as páginas lidas,
+        os contadores e o tempo gasto em cada fase.
+        """
         start_time = datetime.utcnow()
         
+        stats = {
+            'total': 0,
+            'novos': 0,
+            'atualizados': 0,
+            'inalterados': 0,
+            'erros': 0
+        }
+        paginas = []
+        falhas = []
+        tempos = {'preparacao': 0.0, 'busca': 0.0, 'gravacao': 0.0, 'finalizacao': 0.0}
+        
+        def reportar(fase):
+            if progresso:
+                progresso({
+                    'fase': fase,
+                    'paginas': len(paginas),
+                    'itens': stats['total'],
+                    'novos': stats['novos'],
+                    'atualizados': stats['atualizados'],
+                    'inalterados': stats['inalterados'],
+                    'erros': stats['erros'],
+                    'tempos': {k: round(v, 3) for k, v in tempos.items()}
+                })
+        
         try:
-            # Buscar última sincronização bem-sucedida
-            last_sync = LogSincronizacao.query.filter_by(
-                tipo='ops', 
-                status='sucesso'
-            ).order_by(LogSincronizacao.data_execucao.desc()).first()
-            
-            ultima_sincronizacao = last_sync.data_execucao if last_sync else None
-            
-            # Buscar ordens da API
-            orders = self.get_production_orders(ultima_sincronizacao)
-            
-            stats = {
-                'total': len(orders),
-                'novos': 0,
-                'atualizados': 0,
-                'erros': 0
-            }
+            inicio_fase = time.perf_counter()
+            reportar('preparacao')
             
-            for order_data in orders:
-                try:
-                    # Verificar se OP já existe
-                    existing = OrdemProducao.query.filter_by(op=order_data['op']).first()
-                    
-                    if existing:
-                        # Atualiza apenas se não estiver finalizada
-                        if existing.status_op != 'finalizada':
-                            # Atualiza campos
-                            existing.qtde_produzida = order_data['qtde_produzida']
-                            existing.estagio_atual = order_data['estagio_atual']
-                            existing.estagio_posicao = order_data['estagio_posicao']
-                            existing.maquina_atual = self._get_maquina_id_by_code(order_data['maquina_op'])
-                            existing.sincronizado_em = datetime.utcnow()
-                            existing.observacao = order_data['observacao']
-                            existing.unidade_medida = order_data['unidade_medida']
-                            
-                            # Atualizar status baseado na posição do estágio
-                            existing.status_op = self._determine_status(order_data['estagio_posicao'])
-                            
-                            # Se status for finalizada e ainda não tem data de término
-                            if existing.status_op == 'finalizada' and not existing.data_termino:
-                                existing.data_termino = datetime.utcnow()
-                            
-                            stats['atualizados'] += 1
-                    else:
-                        # Cria nova OP
-                        nova_op = OrdemProducao(
-                            op=order_data['op'],
-                            produto=order_data['produto'],
-                            narrativa=order_data['narrativa'],
-                            grupo=order_data['grupo'],
-                            qtde_programado=order_data['qtde_programado'],
-                            qtde_carregado=order_data['qtde_carregado'],
-                            qtde_produzida=order_data['qtde_produzida'],
-                            estagio_atual=order_data['estagio_atual'],
-                            estagio_posicao=order_data['estagio_posicao'],
-                            maquina_atual=self._get_maquina_id_by_code(order_data['maquina_op']),
-                            status_op=self._determine_status(order_data['estagio_posicao']),
-                            origem_api=True,
-                            sincronizado_em=datetime.utcnow(),
-                            observacao=order_data['observacao'],
-                            unidade_medida=order_data['unidade_medida']
-                        )
-                        
-                        # Se status for em andamento e ainda não tem data de início
-                        if nova_op.status_op == 'em_andamento' and not nova_op.data_inicio:
-                            nova_op.data_inicio = datetime.utcnow()
-                        
-                        db.session.add(nova_op)
-                        stats['novos'] += 1
-                        
-                except Exception as e:
-                    stats['erros'] += 1
-                    print(f"Erro processando OP {order_data.get('op', 'N/A')}: {e}")
-                    import traceback
-                    traceback.print_exc()
+            # Marca d'água da última sincronização bem-sucedida, com margem de sobreposição
+            marca_anterior = self._get_watermark('ops')
+            ultima_sincronizacao = marca_anterior - self.delta_overlap if marca_anterior else None
             
-            db.session.commit()
+            resolver = MaquinaResolver.from_database()
+            agora = datetime.utcnow()
+            maior_alteracao = None
+            
+            tempos['preparacao'] = time.perf_counter() - inicio_fase
+            inicio_fase = time.perf_counter()
+            reportar('sincronizacao')
+            
+            # Itens que o ERP mandou malformados entram nas falhas sem interromper a leitura
+            falhas_leitura = []
+            
+            def absorver_falhas_leitura():
+                stats['total'] += len(falhas_leitura)
+                stats['erros'] += len(falhas_leitura)
+                falhas.extend(falhas_leitura)
+                falhas_leitura.clear()
+            
+            # Buscar ordens da API e gravar em lotes de tamanho fixo, um commit por lote
+            orders = self.iter_production_orders(ultima_sincronizacao, paginas=paginas, falhas=falhas_leitura)
+            for lote in iter_chunks(orders, self.commit_size):
+                inicio_gravacao = time.perf_counter()
+                absorver_falhas_leitura()
+                stats['total'] += len(lote)
+                self._sync_chunk(lote, resolver, stats, agora, falhas)
+                db.session.commit()
+                
+                tempos['gravacao'] += time.perf_counter() - inicio_gravacao
+                tempos['busca'] = time.perf_counter() - inicio_fase - tempos['gravacao']
+                reportar('sincronizacao')
+                
+                maior_lote = max((o['alterado_em'] for o in lote if o['alterado_em']), default=None)
+                if maior_lote and (maior_alteracao is None or maior_lote > maior_alteracao):
+                    maior_alteracao = maior_lote
+            
+            absorver_falhas_leitura()
+            
+            # Sem data de alteração vinda do ERP, a marca é o início da busca (e não o fim da sincronização)
+            if maior_alteracao is None and not self.watermark_field:
+                maior_alteracao = start_time
+            
+            # OPs que falharam na gravação precisam voltar no próximo filtro delta: a marca
+            # não passa da alteração mais antiga entre elas e, sem essa data, fica onde
+            # estava (ou no início da busca). Itens malformados na leitura não seguram a
+            # marca: o ERP os mandaria iguais, e só voltam quando forem corrigidos lá
+            falhas_gravacao = [f for f in falhas if f.get('operacao') != 'leitura']
+            if falhas_gravacao and maior_alteracao is not None:
+                if any(not f.get('alterado_em') for f in falhas_gravacao):
+                    maior_alteracao = marca_anterior or start_time
+                else:
+                    menor_falha = min(datetime.fromisoformat(f['alterado_em']) for f in falhas_gravacao)
+                    maior_alteracao = min(maior_alteracao, menor_falha)
+            
+            tempos['busca'] = time.perf_counter() - inicio_fase - tempos['gravacao']
+            inicio_fase = time.perf_counter()
+            reportar('finalizacao')
+            
+            marca_nova = self._set_watermark('ops', maior_alteracao)
             
             # Log da sincronização
             duracao = (datetime.utcnow() - start_time).total_seconds()
@@ -381,31 +775,56 @@ class SystextilAPIClient:
                 registros_processados=stats['total'],
                 registros_novos=stats['novos'],
                 registros_atualizados=stats['atualizados'],
+                registros_inalterados=stats['inalterados'],
                 duracao_segundos=duracao,
                 status='sucesso',
-                mensagem=f"Sincronização realizada com sucesso. {stats['novos']} novos, {stats['atualizados']} atualizados. {stats['erros']} erros."
+                mensagem=f"Sincronização realizada com sucesso. {stats['novos']} novos, {stats['atualizados']} atualizados, {stats['inalterados']} inalterados. {stats['erros']} erros.",
+                detalhes=json.dumps({
+                    'maquinas_resolvidas': resolver.contadores,
+                    'marca_dagua': {
+                        'anterior': marca_anterior.isoformat() if marca_anterior else None,
+                        'filtro': ultima_sincronizacao.strftime(self.delta_format) if ultima_sincronizacao else None,
+                        'nova': marca_nova.isoformat() if marca_nova else None
+                    },
+                    'paginas': paginas,
+                    'falhas': falhas[:MAX_FALHAS_LOG],
+                    'tempos': {k: round(v, 3) for k, v in tempos.items()}
+                })
             )
             
             db.session.add(log)
             db.session.commit()
             
+            tempos['finalizacao'] = time.perf_counter() - inicio_fase
+            reportar('concluido')
+            
             return {
                 'success': True,
                 'stats': stats,
-                'message': f"Sincronização concluída: {stats['novos']} novas OPs, {stats['atualizados']} atualizadas, {stats['erros']} erros"
+                'message': f"Sincronização concluída: {stats['novos']} novas OPs, {stats['atualizados']} atualizadas, {stats['inalterados']} inalteradas, {stats['erros']} erros"
             }
             
         except Exception as e:
+            # Descarta apenas o lote em andamento; os lotes anteriores já foram confirmados
+            db.session.rollback()
+            
             # Log do erro
             duracao = (datetime.utcnow() - start_time).total_seconds()
             
             log = LogSincronizacao(
                 tipo='ops',
-                registros_processados=0,
+                registros_processados=stats['total'],
+                registros_novos=stats['novos'],
+                registros_atualizados=stats['atualizados'],
+                registros_inalterados=stats['inalterados'],
                 duracao_segundos=duracao,
                 status='erro',
                 mensagem=str(e),
-                detalhes=str(e)
+                detalhes=json.dumps({
+                    'erro': str(e),
+                    'paginas': paginas,
+                    'falhas': falhas[:MAX_FALHAS_LOG]
+                })
             )
             
             try:
@@ -419,30 +838,216 @@ class SystextilAPIClient:
                 'message': f"Erro na sincronização: {str(e)}"
             }
     
-    def _get_maquina_id_by_code(self, codigo_maquina):
-        """Busca ID da máquina pelo código"""
-        if not codigo_maquina or codigo_maquina.strip() == '':
-            return None
+    def _sync_chunk(self, orders, resolver, stats, agora, falhas):
+        """Aplica um lote de ordens: carrega as existentes, compara em memória e grava em bulk"""
+        # Carrega de uma vez as OPs já existentes (uma consulta IN por lote)
+        existentes = self._load_existing_ops([o['op'] for o in orders])
+        novas = {}
         
-        # Tentar encontrar máquina pelo código
-        maquina = Maquina.query.filter_by(codigo=codigo_maquina.strip()).first()
+        for order_data in orders:
+            try:
+                maquina_id = resolver.resolve(order_data['maquina_op'])
+                hash_erp = self._hash_order(order_data, maquina_id)
+                
+                # Verificar se OP já existe (no banco ou já vista neste lote)
+                existing = existentes.get(order_data['op']) or novas.get(order_data['op'])
+                
+                if existing:
+                    # Atualiza apenas se não estiver finalizada
+                    if existing['status_op'] != 'finalizada' and existing.get('hash_erp') == hash_erp:
+                        # Nada mudou no ERP desde a última gravação: evita o UPDATE
+                        stats['inalterados'] += 1
+                    elif existing['status_op'] != 'finalizada':
+                        # Atualiza campos
+                        existing['qtde_produzida'] = order_data['qtde_produzida']
+                        existing['estagio_atual'] = order_data['estagio_atual']
+                        existing['estagio_posicao'] = order_data['estagio_posicao']
+                        existing['maquina_atual'] = maquina_id
+                        existing['sincronizado_em'] = agora
+                        existing['observacao'] = order_data['observacao']
+                        existing['unidade_medida'] = order_data['unidade_medida']
+                        existing['hash_erp'] = hash_erp
+                        
+                        # Atualizar status baseado na posição do estágio
+                        existing['status_op'] = self._determine_status(order_data['estagio_posicao'])
+                        
+                        # Se status for finalizada e ainda não tem data de término
+                        if existing['status_op'] == 'finalizada' and not existing.get('data_termino'):
+                            existing['data_termino'] = agora
+                        
+                        existing['_alterada'] = True
+                        stats['atualizados'] += 1
+                else:
+                    # Cria nova OP
+                    nova_op = {
+                        'op': order_data['op'],
+                        'produto': order_data['produto'],
+                        'narrativa': order_data['narrativa'],
+                        'grupo': order_data['grupo'],
+                        'qtde_programado': order_data['qtde_programado'],
+                        'qtde_carregado': order_data['qtde_carregado'],
+                        'qtde_produzida': order_data['qtde_produzida'],
+                        'estagio_atual': order_data['estagio_atual'],
+                        'estagio_posicao': order_data['estagio_posicao'],
+                        'maquina_atual': maquina_id,
+                        'status_op': self._determine_status(order_data['estagio_posicao']),
+                        'origem_api': True,
+                        'data_importacao': agora,
+                        'data_inicio': None,
+                        'data_termino': None,
+                        'sincronizado_em': agora,
+                        'observacao': order_data['observacao'],
+                        'unidade_medida': order_data['unidade_medida'],
+                        'hash_erp': hash_erp
+                    }
+                    
+                    # Se status for em andamento e ainda não tem data de início
+                    if nova_op['status_op'] == 'em_andamento':
+                        nova_op['data_inicio'] = agora
+                    
+                    novas[order_data['op']] = nova_op
+                    stats['novos'] += 1
+            
+            except Exception as e:
+                stats['erros'] += 1
+                alterado_em = order_data.get('alterado_em')
+                falhas.append({
+                    'op': order_data.get('op'),
+                    'erro': str(e),
+                    'alterado_em': alterado_em.isoformat() if alterado_em else None
+                })
+                print(f"Erro processando OP {order_data.get('op', 'N/A')}: {e}")
+                import traceback
+                traceback.print_exc()
+        
+        atualizacoes = [
+            {k: v for k, v in op.items() if k != '_alterada'}
+            for op in existentes.values() if op.get('_alterada')
+        ]
+        
+        alterado_por_op = {o['op']: o['alterado_em'] for o in orders}
+        for falha in self._write_bulk(list(novas.values()), atualizacoes):
+            stats['novos' if falha['operacao'] == 'insert' else 'atualizados'] -= 1
+            stats['erros'] += 1
+            alterado_em = alterado_por_op.get(falha['op'])
+            falha['alterado_em'] = alterado_em.isoformat() if alterado_em else None
+            falhas.append(falha)
+    
+    def _load_existing_ops(self, op_numbers):
+        """Carrega as OPs existentes em consultas IN por lote, indexadas pelo número"""
+        existentes = {}
+        numeros = list(set(op_numbers))
+        
+        for i in range(0, len(numeros), self.batch_size):
+            lote = numeros[i:i + self.batch_size]
+            rows = db.session.query(
+                OrdemProducao.id,
+                OrdemProducao.op,
+                OrdemProducao.status_op,
+                OrdemProducao.data_termino,
+                OrdemProducao.hash_erp
+            ).filter(OrdemProducao.op.in_(lote)).all()
+            
+            for row in rows:
+                existentes[row.op] = {
+                    'id': row.id,
+                    '_op': row.op,
+                    'status_op': row.status_op,
+                    'data_termino': row.data_termino,
+                    'hash_erp': row.hash_erp
+                }
         
-        # Se não encontrar, tentar pelo código QR
-        if not maquina:
-            maquina = Maquina.query.filter_by(codigo_qr=codigo_maquina.strip()).first()
+        return existentes
+    
+    def _get_watermark(self, tipo):
+        """Retorna a marca d'água da sincronização `tipo`.
         
-        # Se ainda não encontrar, tentar encontrar por parte do código
-        if not maquina and '.' in codigo_maquina:
-            # Extrair parte principal do código (ex: TING.001.00001 -> TING.001)
-            parts = codigo_maquina.split('.')
-            if len(parts) >= 2:
-                partial_code = f"{parts[0]}.{parts[1]}"
-                maquina = Maquina.query.filter(Maquina.codigo.like(f"{partial_code}%")).first()
+        Bancos sem marca gravada usam a data da última sincronização bem-sucedida.
+        """
+        marca = MarcaSincronizacao.query.filter_by(tipo=tipo).first()
+        if marca:
+            return marca.marca
         
-        if maquina:
-            return maquina.id
+        last_sync = LogSincronizacao.query.filter_by(
+            tipo=tipo,
+            status='sucesso'
+        ).order_by(LogSincronizacao.data_execucao.desc()).first()
         
-        return None
+        return last_sync.data_execucao if last_sync else None
+    
+    def _set_watermark(self, tipo, valor):
+        """Avança a marca d'água (nunca retrocede) e retorna o valor gravado"""
+        marca = MarcaSincronizacao.query.filter_by(tipo=tipo).first()
+        
+        if valor is None:
+            return marca.marca if marca else None
+        
+        if not marca:
+            marca = MarcaSincronizacao(tipo=tipo, marca=valor)
+            db.session.add(marca)
+        elif valor > marca.marca:
+            marca.marca = valor
+        
+        marca.atualizado_em = datetime.utcnow()
+        return marca.marca
+    
+    def _parse_erp_datetime(self, valor):
+        """Converte datas ISO 8601 do ORDS (ex: 2024-05-01T12:34:56Z) para datetime UTC sem fuso"""
+        if not valor:
+            return None
+        
+        try:
+            data = datetime.fromisoformat(str(valor).replace('Z', '+00:00'))
+        except ValueError:
+            return None
+        
+        if data.tzinfo:
+            data = data.astimezone(timezone.utc).replace(tzinfo=None)
+        return data
+    
+    def _hash_order(self, order_data, maquina_id):
+        """Hash dos campos que a sincronização grava numa OP existente"""
+        campos = [
+            order_data['qtde_produzida'],
+            order_data['estagio_atual'],
+            order_data['estagio_posicao'],
+            maquina_id,
+            order_data['observacao'],
+            order_data['unidade_medida']
+        ]
+        return hashlib.sha256(json.dumps(campos, default=str).encode()).hexdigest()
+    
+    def _write_bulk(self, inserts, updates):
+        """Grava inserções e atualizações em lotes via bulk mappings.
+        
+        Cada lote roda num savepoint; se falhar, o lote é regravado registro a registro
+        (cada um no seu savepoint) para isolar os problemáticos. Retorna a lista de falhas.
+        """
+        falhas = []
+        operacoes = (
+            ('insert', inserts, db.session.bulk_insert_mappings),
+            ('update', updates, db.session.bulk_update_mappings)
+        )
+        
+        for operacao, registros, gravar in operacoes:
+            for i in range(0, len(registros), self.batch_size):
+                lote = registros[i:i + self.batch_size]
+                try:
+                    with db.session.begin_nested():
+                        gravar(OrdemProducao, lote)
+                except SQLAlchemyError:
+                    for registro in lote:
+                        try:
+                            with db.session.begin_nested():
+                                gravar(OrdemProducao, [registro])
+                        except SQLAlchemyError as e:
+                            falhas.append({
+                                'op': registro.get('op', registro.get('_op')),
+                                'operacao': operacao,
+                                'erro': str(getattr(e, 'orig', None) or e)
+                            })
+        
+        return falhas
     
     def _determine_status(self, estagio_posicao):
         """Determina status da OP baseado no estágio"""
@@ -457,15 +1062,454 @@ class SystextilAPIClient:
             return 'em_andamento'
         return 'pendente'
 
+_api_client = None
+_api_client_lock = threading.Lock()
+
+def get_api_client():
+    """Retorna o cliente compartilhado do processo (sessão HTTP e token reaproveitados)"""
+    global _api_client
+    with _api_client_lock:
+        if _api_client is None:
+            _api_client = SystextilAPIClient()
+        return _api_client
+
+# ========== SINCRONIZAÇÃO EM SEGUNDO PLANO ==========
+
+TRAVA_SYNC_OPS = 'sync:ops'
+MAX_FALHAS_LOG = 100
+SYNC_LOCK_TTL_SECONDS = int(os.getenv('SYNC_LOCK_TTL_SECONDS', 600))
+SYNC_STREAM_MAX_SECONDS = int(os.getenv('SYNC_STREAM_MAX_SECONDS', 25))
+
+def acquire_lock(nome, dono, ttl_segundos):
+    """Obtém uma trava compartilhada entre processos (linha em travas_sistema).
+    
+    A trava expira sozinha após ttl_segundos, de modo que um processo que morrer
+    segurando-a não bloqueia os demais para sempre. Retorna True se foi obtida.
+    """
+    tabela = TravaSistema.__table__
+    agora = datetime.utcnow()
+    
+    try:
+        with db.engine.begin() as conn:
+            result = conn.execute(tabela.update().where(
+                tabela.c.nome == nome,
+                db.or_(tabela.c.expira_em.is_(None), tabela.c.expira_em < agora)
+            ).values(dono=dono, expira_em=agora + timedelta(seconds=ttl_segundos)))
+            
+            if result.rowcount == 1:
+                return True
+            
+            existe = conn.execute(db.select(tabela.c.id).where(tabela.c.nome == nome)).first()
+            if existe:
+                return False
+            
+            conn.execute(tabela.insert().values(
+                nome=nome, dono=dono, expira_em=agora + timedelta(seconds=ttl_segundos)
+            ))
+            return True
+    except IntegrityError:
+        # Outro processo criou a trava ao mesmo tempo
+        return False
+
+def renew_lock(nome, dono, ttl_segundos):
+    """Prorroga uma trava que ainda pertence a `dono`"""
+    tabela = TravaSistema.__table__
+    with db.engine.begin() as conn:
+        result = conn.execute(tabela.update().where(
+            tabela.c.nome == nome, tabela.c.dono == dono
+        ).values(expira_em=datetime.utcnow() + timedelta(seconds=ttl_segundos)))
+    return result.rowcount == 1
+
+def release_lock(nome, dono):
+    tabela = TravaSistema.__table__
+    with db.engine.begin() as conn:
+        conn.execute(tabela.update().where(
+            tabela.c.nome == nome, tabela.c.dono == dono
+        ).values(dono=None, expira_em=None))
+
+def start_sync_job(origem='manual', em_segundo_plano=True):
+    """Inicia uma sincronização de OPs ou retorna a que já está em andamento.
+    
+    Retorna (job, iniciado). Se outro processo já segura a trava de sincronização,
+    nenhum job novo é criado e o job em execução (se já registrado) é retornado.
+    """
+    dono = uuid.uuid4().hex
+    
+    if not acquire_lock(TRAVA_SYNC_OPS, dono, SYNC_LOCK_TTL_SECONDS):
+        em_execucao = JobSincronizacao.query.filter(
+            JobSincronizacao.tipo == 'ops',
+            JobSincronizacao.status.in_(['pendente', 'executando'])
+        ).order_by(JobSincronizacao.id.desc()).first()
+        return em_execucao, False
+    
+    try:
+        # Jobs que ficaram abertos sem trava foram interrompidos (processo encerrado)
+        JobSincronizacao.query.filter(
+            JobSincronizacao.tipo == 'ops',
+            JobSincronizacao.status.in_(['pendente', 'executando'])
+        ).update({'status': 'erro', 'mensagem': 'Interrompido', 'finalizado_em': datetime.utcnow()},
+                 synchronize_session=False)
+        
+        job = JobSincronizacao(tipo='ops', origem=origem, status='pendente')
+        db.session.add(job)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        release_lock(TRAVA_SYNC_OPS, dono)
+        raise
+    
+    if em_segundo_plano:
+        threading.Thread(target=_run_sync_job, args=(job.id, dono), daemon=True).start()
+    else:
+        _run_sync_job(job.id, dono)
+    
+    return job, True
+
+def _run_sync_job(job_id, dono):
+    """Executa o job de sincronização segurando (e renovando) a trava"""
+    with app.app_context():
+        parar = threading.Event()
+        
+        def heartbeat():
+            with app.app_context():
+                while not parar.wait(SYNC_LOCK_TTL_SECONDS / 3):
+                    try:
+                        renew_lock(TRAVA_SYNC_OPS, dono, SYNC_LOCK_TTL_SECONDS)
+                    except Exception as e:
+                        print(f"Erro ao renovar trava de sincronização: {e}")
+        
+        threading.Thread(target=heartbeat, daemon=True).start()
+        
+        try:
+            job = db.session.get(JobSincronizacao, job_id)
+            job.status = 'executando'
+            job.iniciado_em = datetime.utcnow()
+            db.session.commit()
+            
+            result = get_api_client().sync_orders_to_database(
+                progresso=lambda dados: save_job_progress(job_id, dados)
+            )
+            
+            job = db.session.get(JobSincronizacao, job_id)
+            job.status = 'sucesso' if result['success'] else 'erro'
+            job.mensagem = result['message']
+            job.resultado = json.dumps(result.get('stats'))
+            job.finalizado_em = datetime.utcnow()
+            db.session.commit()
+            
+        except Exception as e:
+            db.session.rollback()
+            job = db.session.get(JobSincronizacao, job_id)
+            if job:
+                job.status = 'erro'
+                job.mensagem = f"Erro na sincronização: {str(e)}"
+                job.finalizado_em = datetime.utcnow()
+                db.session.commit()
+        finally:
+            parar.set()
+            release_lock(TRAVA_SYNC_OPS, dono)
+            db.session.remove()
+
+def save_job_progress(job_id, dados):
+    """Grava o progresso do job numa conexão própria, visível imediatamente para o stream"""
+    tabela = JobSincronizacao.__table__
+    with db.engine.begin() as conn:
+        conn.execute(tabela.update().where(tabela.c.id == job_id).values(progresso=json.dumps(dados)))
+
+class SyncScheduler(threading.Thread):
+    """Dispara a sincronização de OPs a cada `intervalo_minutos`.
+    
+    Pode rodar em vários processos ao mesmo tempo: a trava garante uma única execução.
+    """
+    
+    def __init__(self, intervalo_minutos):
+        super().__init__(daemon=True, name='sync-scheduler')
+        self.intervalo = intervalo_minutos * 60
+        self._parar = threading.Event()
+    
+    def run(self):
+        while not self._parar.wait(self.intervalo):
+            try:
+                with app.app_context():
+                    job, iniciado = start_sync_job(origem='agendada', em_segundo_plano=False)
+                    if not iniciado:
+                        print("Sincronização agendada ignorada: já existe uma em andamento")
+            except Exception as e:
+                print(f"Erro na sincronização agendada: {e}")
+    
+    def stop(self):
+        self._parar.set()
+
+def start_sync_scheduler():
+    """Inicia o agendador se SYNC_INTERVAL_MINUTES estiver configurado"""
+    intervalo = int(os.getenv('SYNC_INTERVAL_MINUTES', 0))
+    if intervalo <= 0:
+        return None
+    
+    scheduler = SyncScheduler(intervalo)
+    scheduler.start()
+    print(f"⏱️  Sincronização automática a cada {intervalo} minutos")
+    return scheduler
+
+def serialize_job(job):
+    return {
+        'id': job.id,
+        'tipo': job.tipo,
+        'origem': job.origem,
+        'status': job.status,
+        'criado_em': job.criado_em.isoformat() if job.criado_em else None,
+        'iniciado_em': job.iniciado_em.isoformat() if job.iniciado_em else None,
+        'finalizado_em': job.finalizado_em.isoformat() if job.finalizado_em else None,
+        'mensagem': job.mensagem,
+        'resultado': json.loads(job.resultado) if job.resultado else None,
+        'progresso': json.loads(job.progresso) if job.progresso else None
+    }
+
 # ========== FUNÇÕES AUXILIARES ==========
 
-def generate_qr_code(text):
-    """Gera QR Code e retorna como base64"""
+class JSONArrayStream:
+    """Itera incrementalmente um array de um objeto JSON recebido em pedaços.
+    
+    Os elementos do array `campo` são decodificados um a um conforme os bytes chegam,
+    sem montar o documento inteiro na memória. Os demais campos do objeto de topo
+    (ex: hasMore, offset, limit) ficam disponíveis em `metadados` ao final da leitura.
+    """
+    
+    def __init__(self, chunks, campo='items'):
+        self.campo = campo
+        self.metadados = {}
+        self.campo_encontrado = False
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        self._pos = 0
+    
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        
+        while True:
+            chave = self._value()
+            self._expect(':')
+            
+            if chave == self.campo and self._peek() == '[':
+                self.campo_encontrado = True
+                self._expect('[')
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._peek() != ',':
+                            break
+                        self._pos += 1
+                    self._expect(']')
+            else:
+                self.metadados[chave] = self._value()
+            
+            if self._peek() != ',':
+                break
+            self._pos += 1
+        
+        self._expect('}')
+    
+    def _fill(self):
+        """Lê o próximo pedaço descartando o que já foi consumido; False no fim dos dados"""
+        for chunk in self._chunks:
+            texto = self._utf8.decode(chunk)
+            if texto:
+                self._buf = self._buf[self._pos:] + texto
+                self._pos = 0
+                return True
+        return False
+    
+    def _peek(self):
+        """Retorna o próximo caractere não branco sem consumi-lo"""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return None
+    
+    def _expect(self, caractere):
+        if self._peek() != caractere:
+            raise ValueError(f"JSON inválido: esperado '{caractere}' na resposta")
+        self._pos += 1
+    
+    def _value(self):
+        """Decodifica o próximo valor completo, lendo mais pedaços se ele estiver incompleto"""
+        self._peek()
+        while True:
+            try:
+                valor, fim = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            
+            # Um número no final do buffer pode ter sido cortado no meio
+            if fim == len(self._buf) and isinstance(valor, (int, float)) and self._fill():
+                continue
+            
+            self._pos = fim
+            return valor
+
+def iter_chunks(iterable, tamanho):
+    """Agrupa um iterável em listas de até `tamanho` elementos"""
+    iterator = iter(iterable)
+    while True:
+        lote = list(itertools.islice(iterator, tamanho))
+        if not lote:
+            return
+        yield lote
+
+class QRCodeCache:
+    """Cache LRU das imagens de QR Code, indexado pelo texto e parâmetros do QR.
+    
+    Guarda até `max_itens` imagens em memória; se `diretorio` for informado, as imagens
+    também são gravadas em disco e sobrevivem a reinícios e são compartilhadas entre workers.
+    O disco guarda no máximo `max_arquivos`: ao passar do limite, os arquivos lidos há
+    mais tempo (data de modificação, renovada a cada leitura) são apagados.
+    """
+    
+    def __init__(self, max_itens, diretorio=None, max_arquivos=20000):
+        self.max_itens = max_itens
+        self.diretorio = diretorio
+        self.max_arquivos = max_arquivos
+        self._arquivos = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get_or_create(self, parametros, gerar):
+        """Retorna os bytes em cache para `parametros` ou os gera com `gerar()`"""
+        dados = self.get(parametros)
+        if dados is None:
+            dados = gerar()
+            self.put(parametros, dados)
+        return dados
+    
+    def get(self, parametros):
+        """Retorna os bytes em cache (memória ou disco) ou None, contando o miss"""
+        chave = self._chave(parametros)
+        
+        with self._lock:
+            if chave in self._itens:
+                self._itens.move_to_end(chave)
+                self.hits += 1
+                return self._itens[chave]
+        
+        caminho = os.path.join(self.diretorio, chave) if self.diretorio else None
+        if caminho and os.path.exists(caminho):
+            try:
+                with open(caminho, 'rb') as arquivo:
+                    dados = arquivo.read()
+                os.utime(caminho)
+            except OSError:
+                dados = None  # apagado por outro worker ao liberar espaço
+            if dados is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                self._remember(chave, dados)
+                return dados
+        
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def put(self, parametros, dados):
+        """Guarda bytes recém-gerados na memória (e no disco, se configurado)"""
+        chave = self._chave(parametros)
+        if self.diretorio and self._write_file(os.path.join(self.diretorio, chave), dados):
+            self._contar_arquivo()
+        self._remember(chave, dados)
+    
+    def _chave(self, parametros):
+        return hashlib.sha256(json.dumps(parametros).encode()).hexdigest()
+    
+    def _remember(self, chave, dados):
+        with self._lock:
+            self._itens[chave] = dados
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+    
+    def _write_file(self, caminho, dados):
+        try:
+            os.makedirs(self.diretorio, exist_ok=True)
+            temporario = f"{caminho}.{uuid.uuid4().hex}.tmp"
+            with open(temporario, 'wb') as arquivo:
+                arquivo.write(dados)
+            os.replace(temporario, caminho)
+            return True
+        except OSError as e:
+            print(f"Erro ao gravar QR Code no cache em disco: {e}")
+            return False
+    
+    def _contar_arquivo(self):
+        # Contagem aproximada (outros workers também gravam); a limpeza reconta o diretório
+        with self._lock:
+            if self._arquivos is None:
+                self._arquivos = sum(1 for _ in os.scandir(self.diretorio))
+            else:
+                self._arquivos += 1
+            excedeu = self.max_arquivos and self._arquivos > self.max_arquivos
+        if excedeu:
+            self._limpar_disco()
+    
+    def _limpar_disco(self):
+        """Apaga os arquivos lidos há mais tempo até voltar a 90% do limite"""
+        try:
+            arquivos = sorted(
+                (entrada.stat().st_mtime, entrada.path)
+                for entrada in os.scandir(self.diretorio)
+                if entrada.is_file() and not entrada.name.endswith('.tmp')
+            )
+        except OSError as e:
+            print(f"Erro ao limpar o cache de QR Codes em disco: {e}")
+            return
+        
+        excesso = max(len(arquivos) - int(self.max_arquivos * 0.9), 0)
+        for _, caminho in arquivos[:excesso]:
+            try:
+                os.remove(caminho)
+            except OSError:
+                pass
+        with self._lock:
+            self._arquivos = len(arquivos) - excesso
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'itens': len(self._itens),
+                'max_itens': self.max_itens,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'disco': self.diretorio,
+                'arquivos_disco': self._arquivos,
+                'max_arquivos': self.max_arquivos
+            }
+
+qr_cache = QRCodeCache(
+    int(os.getenv('QR_CACHE_SIZE', 2048)),
+    os.path.join(app.instance_path, 'qr_cache') if os.getenv('QR_DISK_CACHE', '').lower() in ('1', 'true') else None,
+    int(os.getenv('QR_DISK_CACHE_MAX', 20000))
+)
+
+def _gerar_qr_png(text, box_size, border):
+    """Desenha o QR Code como PNG (sem cache; usada também pelos processos do pool)"""
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
+        box_size=box_size,
+        border=border,
     )
     qr.add_data(text)
     qr.make(fit=True)
@@ -474,15 +1518,167 @@ def generate_qr_code(text):
     
     buffered = BytesIO()
     img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
+    return buffered.getvalue()
+
+def _gerar_qr_svg(text, box_size, border):
+    """Desenha o QR Code como SVG vetorial, sem passar pelo Pillow (sem cache)"""
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=box_size,
+        border=border,
+    )
+    qr.add_data(text)
+    qr.make(fit=True)
+    
+    # A matriz já inclui a borda; cada sequência de módulos escuros numa
+    # linha vira um único retângulo do path
+    matriz = qr.get_matrix()
+    tamanho = len(matriz)
+    trechos = []
+    for y, linha in enumerate(matriz):
+        x = 0
+        for escuro, grupo in itertools.groupby(linha):
+            largura = len(list(grupo))
+            if escuro:
+                trechos.append(f"M{x} {y}h{largura}v1h-{largura}z")
+            x += largura
+    
+    lado = tamanho * box_size
+    svg = (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {tamanho} {tamanho}" '
+        f'width="{lado}" height="{lado}" shape-rendering="crispEdges">'
+        f'<rect width="{tamanho}" height="{tamanho}" fill="#fff"/>'
+        f'<path d="{"".join(trechos)}" fill="#000"/></svg>'
+    )
+    return svg.encode()
+
+QR_GERADORES = {
+    'png': _gerar_qr_png,
+    'svg': _gerar_qr_svg,
+}
+
+QR_MIMETYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+def render_qr_png(text, box_size=10, border=4):
+    """Gera o QR Code como PNG (bytes), reaproveitando o cache"""
+    return qr_cache.get_or_create(['png', text, box_size, border],
+                                  lambda: _gerar_qr_png(text, box_size, border))
+
+def render_qr_svg(text, box_size=10, border=4):
+    """Gera o QR Code como SVG vetorial (bytes), reaproveitando o cache"""
+    return qr_cache.get_or_create(['svg', text, box_size, border],
+                                  lambda: _gerar_qr_svg(text, box_size, border))
+
+def qr_data_url(dados, formato='png'):
+    """Converte os bytes do QR Code numa data URL"""
+    return f"data:{QR_MIMETYPES[formato]};base64,{base64.b64encode(dados).decode()}"
+
+def generate_qr_code(text, box_size=10, border=4, formato='png'):
+    """Gera QR Code e retorna como base64 (PNG ou SVG)"""
+    render = render_qr_svg if formato == 'svg' else render_qr_png
+    return qr_data_url(render(text, box_size, border), formato)
+
+QR_POOL_WORKERS = int(os.getenv('QR_POOL_WORKERS', min(4, os.cpu_count() or 1)))
+QR_POOL_MIN_LOTE = int(os.getenv('QR_POOL_MIN_LOTE', 64))
+
+_qr_pool = None
+_qr_pool_lock = threading.Lock()
+
+def get_qr_pool():
+    """Retorna o pool de processos compartilhado para geração de QR Codes em lote"""
+    global _qr_pool
+    with _qr_pool_lock:
+        if _qr_pool is None:
+            _qr_pool = ProcessPoolExecutor(max_workers=QR_POOL_WORKERS)
+        return _qr_pool
+
+def _reset_qr_pool():
+    global _qr_pool
+    with _qr_pool_lock:
+        if _qr_pool is not None:
+            _qr_pool.shutdown(wait=False, cancel_futures=True)
+            _qr_pool = None
+
+def render_qr_lote(textos, formato='svg', box_size=10, border=4):
+    """Gera os QR Codes de vários textos e retorna {texto: bytes}.
+    
+    O que já está no cache é reaproveitado; as faltas são desenhadas em paralelo no
+    pool de processos quando passam de QR_POOL_MIN_LOTE (abaixo disso, ou se o pool
+    falhar, são geradas aqui mesmo).
+    """
+    gerar = QR_GERADORES[formato]
+    resultado = {}
+    faltando = []
+    for texto in dict.fromkeys(textos):
+        dados = qr_cache.get([formato, texto, box_size, border])
+        if dados is None:
+            faltando.append(texto)
+        else:
+            resultado[texto] = dados
+    
+    if not faltando:
+        return resultado
     
-    return f"data:image/png;base64,{img_str}"
+    gerados = None
+    if QR_POOL_WORKERS > 1 and len(faltando) >= QR_POOL_MIN_LOTE:
+        chunksize = max(1, len(faltando) // (QR_POOL_WORKERS * 4))
+        try:
+            gerados = list(get_qr_pool().map(
+                gerar, faltando,
+                itertools.repeat(box_size), itertools.repeat(border),
+                chunksize=chunksize
+            ))
+        except (BrokenProcessPool, OSError) as e:
+            print(f"Pool de QR Codes indisponível, gerando no processo atual: {e}")
+            _reset_qr_pool()
+    
+    if gerados is None:
+        gerados = [gerar(texto, box_size, border) for texto in faltando]
+    
+    for texto, dados in zip(faltando, gerados):
+        qr_cache.put([formato, texto, box_size, border], dados)
+        resultado[texto] = dados
+    
+    return resultado
+
+# Colunas acrescentadas a tabelas que já existiam em bancos em produção: o create_all
+# não altera tabelas existentes e o projeto não mantém migrations do Flask-Migrate
+COLUNAS_ADICIONADAS = [
+    OrdemProducao.__table__.c.hash_erp,
+    LogSincronizacao.__table__.c.registros_inalterados,
+]
+
+def atualizar_esquema():
+    """Acrescenta colunas e índices novos em bancos criados por versões anteriores (idempotente)"""
+    inspetor = db.inspect(db.engine)
+    
+    with db.engine.begin() as conn:
+        for coluna in COLUNAS_ADICIONADAS:
+            tabela = coluna.table.name
+            if coluna.name in {c['name'] for c in inspetor.get_columns(tabela)}:
+                continue
+            
+            ddl = f'ALTER TABLE {tabela} ADD COLUMN {coluna.name} {coluna.type.compile(dialect=db.engine.dialect)}'
+            if coluna.default is not None and coluna.default.is_scalar:
+                ddl += f' DEFAULT {coluna.default.arg!r}'
+            conn.execute(db.text(ddl))
+            print(f"Coluna {tabela}.{coluna.name} criada")
+        
+        # Índices declarados nos modelos (create_all só os cria junto com tabelas novas)
+        for tabela in db.metadata.sorted_tables:
+            for indice in tabela.indexes:
+                indice.create(conn, checkfirst=True)
 
 def init_database():
     """Inicializa o banco de dados com dados de exemplo"""
     with app.app_context():
         # Criar tabelas se não existirem
         db.create_all()
+        atualizar_esquema()
         
         # Verificar se já existem dados
         if Usuario.query.count() == 0:
@@ -520,11 +1716,291 @@ def init_database():
                 MotivoParada(codigo='OUT001', descricao='Outros', categoria='diversos', cor='cinza', requer_justificativa=True),
             ]
             
-            for motivo in motivos:
-                db.session.add(motivo)
+            for motivo in motivos:
+                db.session.add(motivo)
+            
+            db.session.commit()
+            print("Banco de dados inicializado com dados de exemplo!")
+
+# ========== RESOLUÇÃO DE QR CODES ==========
+
+# Formato do conteúdo dos QR Codes (versão 1): "<PREFIXO>:<código>", com o prefixo
+# indicando o tipo. Códigos sem prefixo (versão 0, crachás e placas já impressos)
+# continuam aceitos pelo caminho de compatibilidade do scanner.
+# Versão do formato gravado nos QR Codes. Faz parte da URL das imagens (/qr/v1/...), que
+# são servidas como imutáveis: ao mudar qr_payload, aumente a versão para gerar URLs novas
+QR_PAYLOAD_VERSAO = 1
+QR_PREFIXOS = {
+    'U': 'usuario',
+    'M': 'maquina',
+    'OP': 'op',
+}
+QR_PREFIXO_POR_TIPO = {tipo: prefixo for prefixo, tipo in QR_PREFIXOS.items()}
+QR_OP_LEGADO = re.compile(r'^OP(\d+)$', re.IGNORECASE)
+
+def qr_payload(kind, codigo):
+    """Texto gravado no QR Code de um usuário, máquina ou OP"""
+    return f"{QR_PREFIXO_POR_TIPO[kind]}:{codigo}"
+
+def parse_qr_payload(texto):
+    """Separa o tipo e o código de um QR lido; tipo None indica código sem prefixo"""
+    prefixo, separador, codigo = texto.partition(':')
+    tipo = QR_PREFIXOS.get(prefixo.strip().upper())
+    if separador and tipo and codigo.strip():
+        return tipo, codigo.strip()
+    return None, texto
+
+class QRResolver:
+    """Índice em memória codigo_qr -> usuário/máquina usado na leitura dos crachás e placas.
+    
+    O índice é montado sob demanda (uma consulta por tabela) e invalidado pelas rotas
+    de administração que alteram usuários ou máquinas. Como cada processo tem o seu
+    índice, ele também expira após `ttl_segundos`, e um código ausente é conferido no
+    banco com uma única consulta antes de ser recusado.
+    """
+    
+    def __init__(self, ttl_segundos=300, amostras=1000):
+        self.ttl_segundos = ttl_segundos
+        self._indice = None
+        self._montado_em = 0
+        self._lock = threading.Lock()
+        self._latencias = deque(maxlen=amostras)
+        self.contadores = {'resolucoes': 0, 'indice': 0, 'consulta': 0, 'nao_encontrado': 0, 'montagens': 0}
+    
+    def invalidate(self):
+        """Descarta o índice; a próxima leitura o remonta"""
+        with self._lock:
+            self._indice = None
+    
+    def _entrada(self, kind, row):
+        if kind == 'usuario':
+            return {'kind': 'usuario', 'id': row.id, 'nome': row.nome, 'tipo': row.tipo}
+        return {'kind': 'maquina', 'id': row.id, 'nome': row.nome}
+    
+    def _consulta(self, kind, codigo_qr=None):
+        if kind == 'usuario':
+            query = db.session.query(
+                db.literal('usuario').label('kind'), Usuario.id, Usuario.codigo_qr, Usuario.nome, Usuario.tipo
+            ).filter(Usuario.ativo == True)
+            return query.filter(Usuario.codigo_qr == codigo_qr) if codigo_qr is not None else query
+        query = db.session.query(
+            db.literal('maquina').label('kind'), Maquina.id, Maquina.codigo_qr, Maquina.nome, db.null().label('tipo')
+        )
+        return query.filter(Maquina.codigo_qr == codigo_qr) if codigo_qr is not None else query
+    
+    def _get_indice(self):
+        with self._lock:
+            if self._indice is not None and time.monotonic() - self._montado_em < self.ttl_segundos:
+                return self._indice
+        
+        indice = {
+            kind: {row.codigo_qr: self._entrada(kind, row) for row in self._consulta(kind)}
+            for kind in ('usuario', 'maquina')
+        }
+        
+        with self._lock:
+            self._indice = indice
+            self._montado_em = time.monotonic()
+            self.contadores['montagens'] += 1
+        return indice
+    
+    def resolve(self, codigo_qr, kind=None):
+        """Retorna {'kind', 'id', ...} do usuário ativo ou máquina com o código, ou None.
+        
+        Com `kind` informado (QR com prefixo) só aquela tabela é consultada; sem ele,
+        usuários ativos têm prioridade sobre máquinas, como na validação original.
+        """
+        self.contadores['resolucoes'] += 1
+        indice = self._get_indice()
+        tipos = (kind,) if kind else ('usuario', 'maquina')
+        
+        for tipo in tipos:
+            entrada = indice[tipo].get(codigo_qr)
+            if entrada:
+                self.contadores['indice'] += 1
+                return entrada
+        
+        # Cadastrado em outro processo depois da montagem do índice?
+        self.contadores['consulta'] += 1
+        query = self._consulta(tipos[0], codigo_qr)
+        for tipo in tipos[1:]:
+            query = query.union_all(self._consulta(tipo, codigo_qr))
+        rows = query.all()
+        if not rows:
+            self.contadores['nao_encontrado'] += 1
+            return None
+        
+        row = min(rows, key=lambda r: tipos.index(r.kind))
+        entrada = self._entrada(row.kind, row)
+        with self._lock:
+            if self._indice is indice:
+                indice[row.kind][codigo_qr] = entrada
+        return entrada
+    
+    def registrar_latencia(self, segundos):
+        self._latencias.append(segundos * 1000)
+    
+    def stats(self):
+        latencias = sorted(self._latencias)
+        
+        def percentil(p):
+            if not latencias:
+                return None
+            return round(latencias[min(len(latencias) - 1, int(len(latencias) * p))], 3)
+        
+        with self._lock:
+            itens = sum(len(codigos) for codigos in self._indice.values()) if self._indice is not None else 0
+        
+        return {
+            'itens': itens,
+            'ttl_segundos': self.ttl_segundos,
+            'contadores': dict(self.contadores),
+            'latencia_ms': {
+                'amostras': len(latencias),
+                'p50': percentil(0.5),
+                'p95': percentil(0.95),
+                'p99': percentil(0.99),
+                'max': round(latencias[-1], 3) if latencias else None
+            }
+        }
+
+qr_resolver = QRResolver(int(os.getenv('QR_INDEX_TTL_SECONDS', 300)))
+
+# ========== GRAVAÇÃO EM GRUPO ==========
+
+class GroupCommitBuffer:
+    """Confirma num único commit os eventos do chão de fábrica que chegam juntos.
+    
+    Cada rota entrega um `trabalho` (função sem argumentos que só usa db.session e
+    devolve a resposta) e espera o resultado: uma thread própria junta os trabalhos que
+    chegam em até `max_espera_ms` (no máximo `max_lote`), executa todos na mesma
+    transação e faz um commit só. A resposta HTTP continua saindo depois do commit; o
+    ganho é dividir o custo do fsync entre os eventos do lote.
+    
+    Um trabalho que falha recebe a própria exceção e o lote é refeito sem ele, então um
+    evento inválido não derruba os vizinhos. IntegrityError (duas tentativas com a mesma
+    chave de idempotência no mesmo lote) só é entregue depois do commit do restante,
+    para a rota encontrar a resposta gravada pela tentativa que venceu. Os trabalhos
+    rodam fora do contexto da requisição: `session` e `request` devem ser lidos antes.
+    """
+    
+    def __init__(self, max_espera_ms=5, max_lote=200):
+        self.max_espera = max_espera_ms / 1000
+        self.max_lote = max_lote
+        self._fila = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.contadores = {'lotes': 0, 'eventos': 0, 'falhas': 0, 'maior_lote': 0}
+    
+    def submit(self, trabalho):
+        """Enfileira o trabalho; o Future é resolvido depois do commit do lote"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._executar, name='group-commit', daemon=True)
+                self._thread.start()
+        futuro = Future()
+        self._fila.put((trabalho, futuro))
+        return futuro
+    
+    def _executar(self):
+        with app.app_context():
+            while True:
+                lote = [self._fila.get()]
+                limite = time.monotonic() + self.max_espera
+                while len(lote) < self.max_lote:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        break
+                    try:
+                        lote.append(self._fila.get(timeout=restante))
+                    except queue.Empty:
+                        break
+                
+                self._gravar([item for item in lote if item[1].set_running_or_notify_cancel()])
+                db.session.remove()
+    
+    def _gravar(self, pendentes):
+        conflitos = []
+        try:
+            self._gravar_lote(pendentes, conflitos)
+        finally:
+            for futuro, erro in conflitos:
+                futuro.set_exception(erro)
+    
+    def _gravar_lote(self, pendentes, conflitos):
+        while pendentes:
+            resultados = []
+            try:
+                for trabalho, _ in pendentes:
+                    resultado = trabalho()
+                    db.session.flush()
+                    resultados.append(resultado)
+            except Exception as e:
+                db.session.rollback()
+                _, futuro = pendentes.pop(len(resultados))
+                if isinstance(e, IntegrityError):
+                    conflitos.append((futuro, e))
+                else:
+                    futuro.set_exception(e)
+                self.contadores['falhas'] += 1
+                continue
+            
+            try:
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                for _, futuro in pendentes:
+                    futuro.set_exception(e)
+                self.contadores['falhas'] += len(pendentes)
+                return
             
-            db.session.commit()
-            print("Banco de dados inicializado com dados de exemplo!")
+            for (_, futuro), resultado in zip(pendentes, resultados):
+                futuro.set_result(resultado)
+            self.contadores['lotes'] += 1
+            self.contadores['eventos'] += len(pendentes)
+            self.contadores['maior_lote'] = max(self.contadores['maior_lote'], len(pendentes))
+            return
+    
+    def stats(self):
+        lotes = self.contadores['lotes']
+        return dict(
+            self.contadores,
+            media_por_lote=round(self.contadores['eventos'] / lotes, 2) if lotes else 0,
+            max_espera_ms=self.max_espera * 1000,
+            max_lote=self.max_lote
+        )
+
+# Desligado por padrão: cada evento faz o próprio commit, como antes
+GROUP_COMMIT_TIMEOUT = float(os.getenv('GROUP_COMMIT_TIMEOUT', 30))
+group_commit = GroupCommitBuffer(
+    max_espera_ms=float(os.getenv('GROUP_COMMIT_MAX_ESPERA_MS', 5)),
+    max_lote=int(os.getenv('GROUP_COMMIT_MAX_LOTE', 200))
+) if os.getenv('GROUP_COMMIT', '').lower() in ('1', 'true') else None
+
+def executar_gravacao(trabalho):
+    """Executa `trabalho` e confirma a transação, devolvendo o resultado dele.
+    
+    Com GROUP_COMMIT ligado o commit é feito pelo buffer, junto com os eventos vizinhos;
+    nos dois casos só retorna depois de gravado, e exceções do trabalho (inclusive o
+    IntegrityError do commit) chegam a quem chamou.
+    """
+    if group_commit is None:
+        resultado = trabalho()
+        db.session.commit()
+        return resultado
+    # A requisição devolve a sua conexão ao pool enquanto espera: com muitas esperando
+    # ao mesmo tempo, a thread do buffer ficaria sem conexão para gravar
+    db.session.close()
+    futuro = group_commit.submit(trabalho)
+    try:
+        return futuro.result(timeout=GROUP_COMMIT_TIMEOUT)
+    except FuturesTimeoutError:
+        # Retirado da fila, o evento não é gravado depois que o cliente já recebeu o erro
+        # (e um reenvio sem chave de idempotência não o duplica); se o buffer já começou a
+        # gravá-lo, o resultado vem em instantes
+        if futuro.cancel():
+            raise FuturesTimeoutError('Gravação não confirmada a tempo; nada foi gravado')
+        return futuro.result()
 
 # ========== ROTAS PRINCIPAIS ==========
 
@@ -545,6 +2021,75 @@ def scanner_maquina():
         return redirect('/')
     return render_template('scanner_maquina.html')
 
+OPS_POR_PAGINA = int(os.getenv('OPS_POR_PAGINA', 20))
+
+# Ordem das OPs na lista da máquina: as já associadas a ela, as de máquinas do mesmo
+# tipo no setor, as do restante do setor e, por fim, as ainda sem máquina
+CAMADAS_SELECAO_OP = ['maquina', 'tipo', 'setor', 'livre']
+
+def list_ops_for_machine(maquina, busca='', apos=None, limite=OPS_POR_PAGINA):
+    """Lista as OPs disponíveis para a máquina, com paginação por chave.
+    
+    `apos` é o cursor (camada, op) do último item da página anterior. Cada camada é
+    uma consulta por faixa de op no índice ix_ordens_producao_selecao, então o custo
+    de uma página não depende do tamanho da carteira. OPs associadas a máquinas de
+    outros setores não aparecem. Retorna (itens, próximo cursor ou None).
+    """
+    vizinhas = db.session.query(Maquina.id, Maquina.tipo_maquina).filter(
+        Maquina.setor == maquina.setor,
+        Maquina.id != maquina.id
+    ).all()
+    mesmo_tipo = [m.id for m in vizinhas if maquina.tipo_maquina and m.tipo_maquina == maquina.tipo_maquina]
+    mesmo_setor = [m.id for m in vizinhas if m.id not in mesmo_tipo]
+    
+    condicoes = {
+        'maquina': OrdemProducao.maquina_atual == maquina.id,
+        'tipo': OrdemProducao.maquina_atual.in_(mesmo_tipo) if mesmo_tipo else None,
+        'setor': OrdemProducao.maquina_atual.in_(mesmo_setor) if mesmo_setor else None,
+        'livre': OrdemProducao.maquina_atual.is_(None),
+    }
+    
+    base = OrdemProducao.query.filter(
+        OrdemProducao.status_op.in_(['pendente', 'pausado']),
+        OrdemProducao.qtde_produzida < OrdemProducao.qtde_carregado
+    )
+    if busca:
+        filtros = [
+            OrdemProducao.produto.ilike(f"%{busca}%"),
+            OrdemProducao.narrativa.ilike(f"%{busca}%")
+        ]
+        numero = busca.upper().removeprefix('OP').lstrip(':').strip()
+        if numero.isdigit():
+            filtros.append(OrdemProducao.op == int(numero))
+        base = base.filter(db.or_(*filtros))
+    
+    camada_inicial, op_inicial = apos if apos else (0, None)
+    itens = []
+    for indice in range(camada_inicial, len(CAMADAS_SELECAO_OP)):
+        camada = CAMADAS_SELECAO_OP[indice]
+        if condicoes[camada] is None:
+            continue
+        
+        query = base.filter(condicoes[camada])
+        if indice == camada_inicial and op_inicial is not None:
+            query = query.filter(OrdemProducao.op > op_inicial)
+        
+        # Um item a mais indica se existe próxima página
+        for op in query.order_by(OrdemProducao.op).limit(limite + 1 - len(itens)):
+            itens.append({'op': op, 'camada': camada, 'cursor': (indice, op.op)})
+        if len(itens) > limite:
+            break
+    
+    proximo = itens[limite - 1]['cursor'] if len(itens) > limite else None
+    return itens[:limite], proximo
+
+def parse_cursor_selecao(valor):
+    """Lê o cursor 'camada-op' da query string; valores inválidos voltam ao início"""
+    camada, _, op = (valor or '').partition('-')
+    if camada.isdigit() and op.isdigit() and int(camada) < len(CAMADAS_SELECAO_OP):
+        return int(camada), int(op)
+    return None
+
 @app.route('/selecionar_op')
 def selecionar_op():
     """Seleção de OP para a máquina"""
@@ -552,12 +2097,20 @@ def selecionar_op():
         return redirect('/')
     
     maquina = db.session.get(Maquina, session['maquina_id'])
-    ops = OrdemProducao.query.filter(
-        OrdemProducao.status_op.in_(['pendente', 'pausado']),
-        OrdemProducao.qtde_produzida < OrdemProducao.qtde_carregado
-    ).order_by(OrdemProducao.op).all()
     
-    return render_template('selecionar_op.html', ops=ops, maquina=maquina)
+    # O caminho normal é a leitura da ficha (/api/scan_op); a lista é só a alternativa
+    # de busca, paginada para não renderizar todas as OPs da fábrica
+    busca = request.args.get('q', '').strip()
+    apos = parse_cursor_selecao(request.args.get('apos'))
+    
+    itens, proximo = list_ops_for_machine(maquina, busca, apos)
+    
+    return render_template('selecionar_op.html',
+                         itens=itens,
+                         proximo=f"{proximo[0]}-{proximo[1]}" if proximo else None,
+                         primeira_pagina=apos is None,
+                         busca=busca,
+                         maquina=maquina)
 
 @app.route('/production')
 def production():
@@ -580,82 +2133,155 @@ def production():
                          op=op,
                          metros_disponiveis=metros_disponiveis)
 
+@app.route('/sw.js')
+def service_worker():
+    """Service worker das telas do operador, servido na raiz para controlar todo o site"""
+    response = make_response(app.send_static_file('js/sw.js'))
+    response.headers['Content-Type'] = 'application/javascript'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Service-Worker-Allowed'] = '/'
+    return response
+
 # ========== API ROUTES ==========
 
+@app.route('/api/sessao')
+def sessao_atual():
+    """Sessão atual, usada pela fila offline para enviar só os registros do usuário logado
+    e pela tela de produção para conferir se é a da máquina e OP da sessão"""
+    return jsonify({
+        'success': True,
+        'usuario_id': session.get('usuario_id'),
+        'maquina_id': session.get('maquina_id'),
+        'op_id': session.get('op_id')
+    })
+
 @app.route('/api/validate_qr', methods=['POST'])
 def validate_qr():
     """Valida QR Code escaneado"""
+    inicio = time.perf_counter()
     data = request.json
     qr_code = data.get('qr_code', '').strip()
     
+    resposta = _resolve_scan(qr_code)
+    
+    duracao = time.perf_counter() - inicio
+    qr_resolver.registrar_latencia(duracao)
+    resposta.headers['Server-Timing'] = f"qr;dur={duracao * 1000:.2f}"
+    return resposta
+
+def _resolve_scan(qr_code):
+    kind, codigo = parse_qr_payload(qr_code)
+    
+    if kind == 'op':
+        return _scan_op(codigo)
+    
+    alvo = qr_resolver.resolve(codigo, kind)
+    
+    # Códigos "OP123" impressos antes dos prefixos
+    if alvo is None and kind is None:
+        legado = QR_OP_LEGADO.match(codigo)
+        if legado:
+            return _scan_op(legado.group(1))
+    
     # Verificar se é usuário
-    usuario = Usuario.query.filter_by(codigo_qr=qr_code, ativo=True).first()
-    if usuario:
-        session['usuario_id'] = usuario.id
-        session['usuario_nome'] = usuario.nome
-        session['usuario_tipo'] = usuario.tipo
+    if alvo and alvo['kind'] == 'usuario':
+        session['usuario_id'] = alvo['id']
+        session['usuario_nome'] = alvo['nome']
+        session['usuario_tipo'] = alvo['tipo']
         
-        if usuario.tipo == 'operador':
-            return jsonify({
-                'success': True,
-                'redirect': '/scanner_maquina',
-                'usuario': {
-                    'id': usuario.id,
-                    'nome': usuario.nome,
-                    'tipo': usuario.tipo
-                }
-            })
-        else:
-            return jsonify({
-                'success': True,
-                'redirect': '/admin/dashboard',
-                'usuario': {
-                    'id': usuario.id,
-                    'nome': usuario.nome,
-                    'tipo': usuario.tipo
-                }
-            })
+        return jsonify({
+            'success': True,
+            'redirect': '/scanner_maquina' if alvo['tipo'] == 'operador' else '/admin/dashboard',
+            'usuario': {
+                'id': alvo['id'],
+                'nome': alvo['nome'],
+                'tipo': alvo['tipo']
+            }
+        })
     
-    # Verificar se é máquina
-    maquina = Maquina.query.filter_by(codigo_qr=qr_code).first()
-    if maquina:
-        session['maquina_id'] = maquina.id
-        session['maquina_nome'] = maquina.nome
-        
-        op_ativa = OrdemProducao.query.filter_by(
-            maquina_atual=maquina.id,
-            status_op='em_andamento'
-        ).first()
+    # Verificar se é máquina (status e OP ativa numa única consulta)
+    if alvo and alvo['kind'] == 'maquina':
+        linha = db.session.query(
+            Maquina.status,
+            OrdemProducao.id.label('op_id'),
+            OrdemProducao.op,
+            OrdemProducao.produto
+        ).outerjoin(
+            OrdemProducao,
+            db.and_(OrdemProducao.maquina_atual == Maquina.id, OrdemProducao.status_op == 'em_andamento')
+        ).filter(Maquina.id == alvo['id']).first()
+        
+        if linha is None:
+            # Máquina removida depois da montagem do índice
+            qr_resolver.invalidate()
+            return jsonify({'success': False, 'message': 'QR Code não reconhecido'})
+        
+        session['maquina_id'] = alvo['id']
+        session['maquina_nome'] = alvo['nome']
+        
+        maquina = {
+            'id': alvo['id'],
+            'nome': alvo['nome'],
+            'status': linha.status
+        }
         
-        if op_ativa:
-            session['op_id'] = op_ativa.id
+        if linha.op_id:
+            session['op_id'] = linha.op_id
             return jsonify({
                 'success': True,
                 'redirect': '/production',
-                'maquina': {
-                    'id': maquina.id,
-                    'nome': maquina.nome,
-                    'status': maquina.status
-                },
+                'maquina': maquina,
                 'op_ativa': {
-                    'id': op_ativa.id,
-                    'op': op_ativa.op,
-                    'produto': op_ativa.produto
+                    'id': linha.op_id,
+                    'op': linha.op,
+                    'produto': linha.produto
                 }
             })
         else:
             return jsonify({
                 'success': True,
                 'redirect': '/selecionar_op',
-                'maquina': {
-                    'id': maquina.id,
-                    'nome': maquina.nome,
-                    'status': maquina.status
-                }
+                'maquina': maquina
             })
     
     return jsonify({'success': False, 'message': 'QR Code não reconhecido'})
 
+def _scan_op(numero):
+    """Leitura direta da ficha da OP: associa a OP à máquina já escaneada"""
+    if not numero.isdigit():
+        return jsonify({'success': False, 'message': 'QR Code não reconhecido'})
+    
+    if 'maquina_id' not in session:
+        return jsonify({'success': False, 'message': 'Escaneie a máquina antes da OP'})
+    
+    op = OrdemProducao.query.filter_by(op=int(numero)).first()
+    if not op:
+        return jsonify({'success': False, 'message': 'OP não encontrada'})
+    
+    if op.status_op == 'finalizada':
+        return jsonify({'success': False, 'message': f'OP {op.op} já finalizada'})
+    
+    return jsonify(assign_op_to_machine(op))
+
+@app.route('/api/scan_op', methods=['POST'])
+def scan_op():
+    """Seleciona a OP pela leitura do QR da ficha (ou pelo número digitado)"""
+    if 'maquina_id' not in session:
+        return jsonify({'success': False, 'message': 'Sessão inválida'})
+    
+    data = request.json or {}
+    kind, codigo = parse_qr_payload(str(data.get('qr_code', '')).strip())
+    
+    if kind is None:
+        # Fichas antigas ("OP123") ou número digitado pelo operador
+        legado = QR_OP_LEGADO.match(codigo)
+        kind, codigo = 'op', legado.group(1) if legado else codigo
+    
+    if kind != 'op':
+        return jsonify({'success': False, 'message': 'Este QR Code não é de uma OP'})
+    
+    return _scan_op(codigo)
+
 @app.route('/api/selecionar_op/<int:op_id>', methods=['POST'])
 def selecionar_op_api(op_id):
     """Seleciona OP para produção"""
@@ -666,6 +2292,10 @@ def selecionar_op_api(op_id):
     if not op:
         return jsonify({'success': False, 'message': 'OP não encontrada'})
     
+    return jsonify(assign_op_to_machine(op))
+
+def assign_op_to_machine(op):
+    """Coloca a OP em produção na máquina da sessão"""
     op.maquina_atual = session['maquina_id']
     op.status_op = 'em_andamento'
     if not op.data_inicio:
@@ -678,7 +2308,7 @@ def selecionar_op_api(op_id):
     
     db.session.commit()
     
-    return jsonify({
+    return {
         'success': True,
         'redirect': '/production',
         'op': {
@@ -686,56 +2316,386 @@ def selecionar_op_api(op_id):
             'numero': op.op,
             'produto': op.produto
         }
-    })
+    }
+
+IDEMPOTENCIA_CHAVE_MAX = 64
+
+def get_idempotency_key(data):
+    """Chave de idempotência enviada pelo cliente (campo chave_idempotencia ou cabeçalho Idempotency-Key).
+    
+    Chaves maiores que a coluna são recusadas com 400: cortá-las faria duas chaves com o
+    mesmo começo devolverem a resposta uma da outra.
+    """
+    chave = str(data.get('chave_idempotencia') or request.headers.get('Idempotency-Key') or '').strip()
+    if len(chave) > IDEMPOTENCIA_CHAVE_MAX:
+        abort(make_response(jsonify({
+            'success': False,
+            'message': f'Chave de idempotência maior que {IDEMPOTENCIA_CHAVE_MAX} caracteres'
+        }), 400))
+    return chave or None
+
+def find_idempotent_response(chave, operacao):
+    """Resposta já gravada para a chave, ou None se ela ainda não foi usada"""
+    registro = RequisicaoIdempotente.query.filter_by(chave=chave).first()
+    if registro is None:
+        return None
+    if registro.operacao != operacao or registro.usuario_id != session.get('usuario_id'):
+        return {'success': False, 'message': 'Chave de idempotência já utilizada em outra requisição'}
+    return json.loads(registro.resposta)
+
+def store_idempotent_response(chave, operacao, resposta, usuario_id):
+    """Grava a resposta junto com a transação corrente; o índice único barra a repetição"""
+    if chave:
+        db.session.add(RequisicaoIdempotente(
+            chave=chave,
+            operacao=operacao,
+            usuario_id=usuario_id,
+            resposta=json.dumps(resposta)
+        ))
+
+def _replay_apontamento(resposta):
+    # Se a resposta original se perdeu, o cookie ainda traz a máquina/OP encerradas
+    if resposta.get('redirect') == '/scanner_maquina':
+        session.pop('maquina_id', None)
+        session.pop('op_id', None)
+    return jsonify(dict(resposta, duplicado=True) if resposta.get('success') else resposta)
 
 @app.route('/api/registrar_apontamento', methods=['POST'])
 def registrar_apontamento():
     """Registra apontamento de produção"""
     data = request.json
     
-    if 'usuario_id' not in session or 'maquina_id' not in session or 'op_id' not in session:
+    if 'usuario_id' not in session:
+        return jsonify({'success': False, 'message': 'Sessão inválida'})
+    
+    # Reenvio de um apontamento já gravado: devolve a resposta original sem gravar de novo
+    chave = get_idempotency_key(data)
+    if chave:
+        anterior = find_idempotent_response(chave, 'apontamento')
+        if anterior is not None:
+            return _replay_apontamento(anterior)
+    
+    if 'maquina_id' not in session or 'op_id' not in session:
         return jsonify({'success': False, 'message': 'Sessão inválida'})
     
     try:
-        apontamento = Apontamento(
-            usuario_id=session['usuario_id'],
-            maquina_id=session['maquina_id'],
-            op_id=session['op_id'],
-            metros_processados=float(data['metros_processados']),
-            observacao=data.get('observacao', ''),
-            data_hora_fim=datetime.utcnow(),
-            status_apontamento='finalizado'
-        )
-        
-        db.session.add(apontamento)
-        
-        op = db.session.get(OrdemProducao, session['op_id'])
-        op.qtde_produzida += float(data['metros_processados'])
-        
-        if op.qtde_produzida >= op.qtde_carregado:
-            op.status_op = 'finalizada'
-            op.data_termino = datetime.utcnow()
+        usuario_id = session['usuario_id']
+        maquina_id = session['maquina_id']
+        op_id = session['op_id']
+        metros = float(data['metros_processados'])
+        observacao = data.get('observacao', '')
+        
+        def gravar():
+            # Soma feita no banco: dois apontamentos simultâneos na mesma OP não se sobrescrevem
+            totais = increment_op_produzida(op_id, metros)
+            if totais is None:
+                return {'success': False, 'message': 'OP não encontrada'}
             
-            maquina = db.session.get(Maquina, session['maquina_id'])
-            maquina.status = 'parada'
+            db.session.add(Apontamento(
+                usuario_id=usuario_id,
+                maquina_id=maquina_id,
+                op_id=op_id,
+                metros_processados=metros,
+                observacao=observacao,
+                data_hora_fim=datetime.utcnow(),
+                status_apontamento='finalizado'
+            ))
+            
+            if totais.qtde_produzida >= totais.qtde_carregado:
+                finish_op(op_id)
+                
+                maquina = db.session.get(Maquina, maquina_id)
+                maquina.status = 'parada'
+                
+                redirect_url = '/scanner_maquina'
+            else:
+                redirect_url = '/production?continue=true'
             
+            resposta = {
+                'success': True,
+                'message': 'Produção registrada com sucesso!',
+                'redirect': redirect_url
+            }
+            store_idempotent_response(chave, 'apontamento', resposta, usuario_id)
+            return resposta
+        
+        resposta = executar_gravacao(gravar)
+        
+        if resposta.get('redirect') == '/scanner_maquina':
             session.pop('maquina_id', None)
             session.pop('op_id', None)
-            redirect_url = '/scanner_maquina'
-        else:
-            redirect_url = '/production?continue=true'
         
-        db.session.commit()
+        return jsonify(resposta)
         
-        return jsonify({
-            'success': True,
-            'message': 'Produção registrada com sucesso!',
-            'redirect': redirect_url
-        })
+    except IntegrityError:
+        # Duas tentativas com a mesma chave ao mesmo tempo: vale a que gravou primeiro
+        db.session.rollback()
+        anterior = find_idempotent_response(chave, 'apontamento') if chave else None
+        if anterior is not None:
+            return _replay_apontamento(anterior)
+        return jsonify({'success': False, 'message': 'Erro: apontamento em conflito'})
+    
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'Erro: {str(e)}'})
+
+def increment_op_produzida(op_id, metros):
+    """Soma `metros` à produção da OP numa única instrução SQL.
+    
+    Retorna a linha (qtde_produzida, qtde_carregado) já com a soma aplicada, ou None se
+    a OP não existir. A linha fica travada até o commit da transação corrente.
+    """
+    incremento = db.update(OrdemProducao).where(OrdemProducao.id == op_id).values(
+        qtde_produzida=db.func.coalesce(OrdemProducao.qtde_produzida, 0) + metros
+    )
+    
+    if db.engine.dialect.update_returning:
+        return db.session.execute(
+            incremento.returning(OrdemProducao.qtde_produzida, OrdemProducao.qtde_carregado)
+        ).first()
+    
+    # Sem RETURNING (MySQL): o UPDATE já travou a linha, então a leitura seguinte na
+    # mesma transação enxerga exatamente o valor gravado por ele
+    if db.session.execute(incremento).rowcount == 0:
+        return None
+    return db.session.execute(
+        db.select(OrdemProducao.qtde_produzida, OrdemProducao.qtde_carregado)
+        .where(OrdemProducao.id == op_id)
+    ).first()
+
+def finish_op(op_id):
+    """Marca a OP como finalizada (só a primeira chamada grava a data de término)"""
+    db.session.execute(
+        db.update(OrdemProducao)
+        .where(OrdemProducao.id == op_id, OrdemProducao.status_op != 'finalizada')
+        .values(status_op='finalizada', data_termino=datetime.utcnow())
+    )
+
+APONTAMENTOS_LOTE_MAX = int(os.getenv('APONTAMENTOS_LOTE_MAX', 1000))
+
+def _parse_data_hora(valor):
+    """Converte um campo de data/hora ISO para UTC sem fuso (None se ausente); ValueError se inválido.
+    
+    Horários sem fuso são tomados como UTC, como os gravados pelo sistema.
+    """
+    if valor in (None, ''):
+        return None
+    data = datetime.fromisoformat(str(valor).replace('Z', '+00:00'))
+    if data.tzinfo:
+        data = data.astimezone(timezone.utc).replace(tzinfo=None)
+    return data
+
+@app.route('/api/apontamentos/batch', methods=['POST'])
+def registrar_apontamentos_lote():
+    """Registra vários apontamentos numa única transação.
+    
+    Corpo: {"apontamentos": [{usuario_id, maquina_id, op_id ou op, metros_processados,
+    data_hora_inicio, data_hora_fim, observacao, chave_idempotencia}, ...]}. Operadores só
+    lançam em seu próprio nome e na OP que está na máquina informada (campos ausentes vêm
+    da sessão); administradores e supervisores podem informar qualquer usuário e OP, para
+    carga de planilhas antigas.
+    Itens inválidos são recusados individualmente e o restante é gravado; a produção
+    de cada OP é somada uma única vez com o total do lote.
+    """
+    if 'usuario_id' not in session:
+        return jsonify({'success': False, 'message': 'Sessão inválida', 'retentar': True})
+    
+    itens = (request.json or {}).get('apontamentos')
+    if not isinstance(itens, list) or not itens:
+        return jsonify({'success': False, 'message': 'Envie a lista "apontamentos"'}), 400
+    if len(itens) > APONTAMENTOS_LOTE_MAX:
+        return jsonify({'success': False, 'message': f'Máximo de {APONTAMENTOS_LOTE_MAX} apontamentos por lote'}), 400
+    
+    pode_lancar_por_outros = session.get('usuario_tipo') in ('admin', 'supervisor')
+    agora = datetime.utcnow()
+    resultados = [None] * len(itens)
+    
+    # Leitura de todos os cadastros citados no lote de uma vez
+    def ids(campo, padrao=None):
+        valores = set()
+        for item in itens:
+            valor = item.get(campo, padrao) if isinstance(item, dict) else None
+            if isinstance(valor, int) or (isinstance(valor, str) and valor.isdigit()):
+                valores.add(int(valor))
+        return valores
+    
+    usuarios = {u.id: u for u in Usuario.query.filter(
+        Usuario.id.in_(ids('usuario_id', session['usuario_id'])), Usuario.ativo == True)}
+    maquinas = {m.id: m for m in Maquina.query.filter(
+        Maquina.id.in_(ids('maquina_id', session.get('maquina_id'))))}
+    ops_por_id = {}
+    for op in OrdemProducao.query.filter(db.or_(
+        OrdemProducao.id.in_(ids('op_id', session.get('op_id'))),
+        OrdemProducao.op.in_(ids('op'))
+    )):
+        ops_por_id[op.id] = op
+    ops_por_numero = {op.op: op for op in ops_por_id.values()}
+    
+    # Cada item traz a sua própria chave (o cabeçalho Idempotency-Key não vale para o lote)
+    chaves = [
+        str(item.get('chave_idempotencia') or '').strip() or None if isinstance(item, dict) else None
+        for item in itens
+    ]
+    ja_gravadas = {r.chave: r for r in RequisicaoIdempotente.query.filter(
+        RequisicaoIdempotente.chave.in_([c for c in chaves if c]))}
+    
+    validos = []
+    chaves_no_lote = {}
+    for indice, item in enumerate(itens):
+        if not isinstance(item, dict):
+            resultados[indice] = {'indice': indice, 'success': False, 'message': 'Item inválido'}
+            continue
+        
+        chave = chaves[indice]
+        if chave and len(chave) > IDEMPOTENCIA_CHAVE_MAX:
+            resultados[indice] = {'indice': indice, 'success': False,
+                                  'message': f'Chave de idempotência maior que {IDEMPOTENCIA_CHAVE_MAX} caracteres'}
+            continue
+        if chave in ja_gravadas:
+            registro = ja_gravadas[chave]
+            if registro.operacao != 'apontamento' or registro.usuario_id != session['usuario_id']:
+                resposta = {'success': False, 'message': 'Chave de idempotência já utilizada em outra requisição'}
+            else:
+                resposta = dict(json.loads(registro.resposta), duplicado=True)
+            resultados[indice] = dict(resposta, indice=indice)
+            continue
+        if chave in chaves_no_lote:
+            resultados[indice] = {'indice': indice, 'duplicado_de': chaves_no_lote[chave]}
+            continue
         
+        try:
+            usuario_id = int(item.get('usuario_id', session['usuario_id']))
+            maquina_id = int(item.get('maquina_id', session.get('maquina_id')))
+            if item.get('op') is not None:
+                op = ops_por_numero.get(int(item['op']))
+            else:
+                op = ops_por_id.get(int(item.get('op_id', session.get('op_id'))))
+            metros = float(item['metros_processados'])
+            inicio = _parse_data_hora(item.get('data_hora_inicio'))
+            fim = _parse_data_hora(item.get('data_hora_fim')) or agora
+        except (KeyError, TypeError, ValueError):
+            resultados[indice] = {'indice': indice, 'success': False, 'message': 'Campos ausentes ou inválidos'}
+            continue
+        
+        # Apontamento de outro operador (tablet compartilhado na troca de turno): o
+        # aparelho guarda o item e o reenvia quando o dono entrar de novo
+        retentar = usuario_id != session['usuario_id'] and not pode_lancar_por_outros
+        if retentar:
+            erro = 'Operador só pode lançar apontamentos próprios'
+        elif usuario_id not in usuarios:
+            erro = 'Usuário não encontrado ou inativo'
+        elif maquina_id not in maquinas:
+            erro = 'Máquina não encontrada'
+        elif op is None:
+            erro = 'OP não encontrada'
+        elif op.maquina_atual != maquina_id and not pode_lancar_por_outros:
+            erro = 'OP não está na máquina informada'
+        elif metros <= 0:
+            erro = 'Metros processados devem ser maiores que zero'
+        elif inicio and inicio > fim:
+            erro = 'Início posterior ao fim'
+        else:
+            erro = None
+        
+        if erro:
+            resultados[indice] = {'indice': indice, 'success': False, 'message': erro}
+            if retentar:
+                resultados[indice]['retentar'] = True
+            continue
+        
+        if chave:
+            chaves_no_lote[chave] = indice
+        validos.append((indice, chave, {
+            'usuario_id': usuario_id,
+            'maquina_id': maquina_id,
+            'op_id': op.id,
+            'metros_processados': metros,
+            'observacao': item.get('observacao', ''),
+            'data_hora_inicio': inicio or fim,
+            'data_hora_fim': fim,
+            'status_apontamento': 'finalizado'
+        }))
+    
+    # A gravação passa pelo buffer de gravação em grupo quando ele está ligado; roda em
+    # outra thread, por isso o usuário da sessão é lido antes
+    usuario_sessao = session['usuario_id']
+    
+    def gravar():
+        apontamentos = [(indice, chave, Apontamento(**dados)) for indice, chave, dados in validos]
+        db.session.add_all([apontamento for _, _, apontamento in apontamentos])
+        db.session.flush()
+        
+        # Uma soma por OP, sempre na mesma ordem para lotes concorrentes não se travarem
+        total_por_op = {}
+        ultima_maquina = {}
+        for _, _, apontamento in sorted(apontamentos, key=lambda v: v[2].data_hora_fim):
+            total_por_op[apontamento.op_id] = total_por_op.get(apontamento.op_id, 0) + apontamento.metros_processados
+            ultima_maquina[apontamento.op_id] = apontamento.maquina_id
+        
+        finalizadas = set()
+        for op_id in sorted(total_por_op):
+            totais = increment_op_produzida(op_id, total_por_op[op_id])
+            if totais and totais.qtde_produzida >= totais.qtde_carregado:
+                finish_op(op_id)
+                db.session.get(Maquina, ultima_maquina[op_id]).status = 'parada'
+                finalizadas.add(op_id)
+        
+        respostas = {}
+        respostas_gravadas = []
+        for indice, chave, apontamento in apontamentos:
+            finalizada = apontamento.op_id in finalizadas
+            resposta = {
+                'success': True,
+                'message': 'Produção registrada com sucesso!',
+                'redirect': '/scanner_maquina' if finalizada else '/production?continue=true',
+                'apontamento_id': apontamento.id,
+                'op_finalizada': finalizada
+            }
+            if chave:
+                respostas_gravadas.append({
+                    'chave': chave,
+                    'operacao': 'apontamento',
+                    'usuario_id': usuario_sessao,
+                    'resposta': json.dumps(resposta)
+                })
+            respostas[indice] = resposta
+        
+        if respostas_gravadas:
+            db.session.execute(db.insert(RequisicaoIdempotente), respostas_gravadas)
+        return respostas, finalizadas
+    
+    try:
+        respostas, ops_finalizadas = executar_gravacao(gravar)
+    
+    except IntegrityError:
+        # Outra requisição gravou uma das chaves ao mesmo tempo: o cliente reenvia o lote
+        # e os itens já gravados voltam como duplicados
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Lote em conflito com outro envio; tente novamente'}), 409
+    
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'message': f'Erro: {str(e)}'})
+    
+    for indice, resposta in respostas.items():
+        resultados[indice] = dict(resposta, indice=indice)
+    
+    # Itens repetidos dentro do próprio lote recebem o resultado do primeiro
+    for indice, resultado in enumerate(resultados):
+        if 'duplicado_de' in resultado:
+            resultados[indice] = dict(resultados[resultado['duplicado_de']], indice=indice, duplicado=True)
+    
+    if session.get('op_id') in ops_finalizadas:
+        session.pop('maquina_id', None)
+        session.pop('op_id', None)
+    
+    gravados = len(validos)
+    return jsonify({
+        'success': True,
+        'message': f'{gravados} de {len(itens)} apontamento(s) registrado(s)',
+        'gravados': gravados,
+        'resultados': resultados
+    })
 
 @app.route('/api/get_motivos_parada')
 def get_motivos_parada():
@@ -756,43 +2716,90 @@ def get_motivos_parada():
 
 @app.route('/api/registrar_parada', methods=['POST'])
 def registrar_parada():
-    """Registra parada de máquina"""
+    """Registra parada de máquina.
+    
+    Paradas guardadas no aparelho durante uma queda de rede chegam depois, quando a
+    sessão já pode estar em outra máquina; por isso maquina_id, op_id e data_hora_inicio
+    podem vir no corpo (na falta deles valem a sessão e o horário atual). A OP informada
+    precisa estar na máquina, e parar outra máquina que não a da sessão exige a OP dela.
+    """
     data = request.json
     
-    if 'usuario_id' not in session or 'maquina_id' not in session:
+    # retentar: recusa ligada à sessão, e não à parada; a fila do aparelho a reenvia depois
+    if 'usuario_id' not in session:
+        return jsonify({'success': False, 'message': 'Sessão inválida', 'retentar': True})
+    
+    if data.get('usuario_id') not in (None, session['usuario_id']):
+        return jsonify({'success': False, 'message': 'Operador só pode registrar paradas próprias', 'retentar': True})
+    
+    chave = get_idempotency_key(data)
+    if chave:
+        anterior = find_idempotent_response(chave, 'parada')
+        if anterior is not None:
+            return jsonify(dict(anterior, duplicado=True) if anterior.get('success') else anterior)
+    
+    maquina_id = data.get('maquina_id', session.get('maquina_id'))
+    op_id = data.get('op_id', session.get('op_id'))
+    if maquina_id is None:
         return jsonify({'success': False, 'message': 'Sessão inválida'})
     
     try:
-        parada = ParadaMaquina(
-            maquina_id=session['maquina_id'],
-            usuario_id=session['usuario_id'],
-            motivo_id=data.get('motivo_id'),
-            motivo_personalizado=data.get('motivo_personalizado', ''),
-            justificativa=data.get('justificativa', ''),
-            categoria=data.get('categoria', 'nao_planejada'),
-            data_hora_inicio=datetime.utcnow()
-        )
-        
-        db.session.add(parada)
-        
-        maquina = db.session.get(Maquina, session['maquina_id'])
-        maquina.status = 'parada'
-        
-        if 'op_id' in session:
-            op = db.session.get(OrdemProducao, session['op_id'])
+        usuario_id = session['usuario_id']
+        maquina_sessao = session.get('maquina_id')
+        maquina_id = int(maquina_id)
+        op_id = int(op_id) if op_id is not None else None
+        inicio = _parse_data_hora(data.get('data_hora_inicio')) or datetime.utcnow()
+        
+        def gravar():
+            maquina = db.session.get(Maquina, maquina_id)
+            if not maquina:
+                return {'success': False, 'message': 'Máquina não encontrada'}
+            
+            # Parada de outra máquina que não a da sessão só vale com a OP que está nela
+            op = db.session.get(OrdemProducao, op_id) if op_id is not None else None
+            if op_id is not None and (op is None or op.maquina_atual != maquina_id):
+                return {'success': False, 'message': 'OP não está na máquina informada'}
+            if op is None and maquina_id != maquina_sessao:
+                return {'success': False, 'message': 'Parada de outra máquina exige a OP dela'}
+            
+            db.session.add(ParadaMaquina(
+                maquina_id=maquina_id,
+                usuario_id=usuario_id,
+                motivo_id=data.get('motivo_id'),
+                motivo_personalizado=data.get('motivo_personalizado', ''),
+                justificativa=data.get('justificativa', ''),
+                categoria=data.get('categoria', 'nao_planejada'),
+                data_hora_inicio=inicio
+            ))
+            
+            maquina.status = 'parada'
+            
             if op and op.status_op == 'em_andamento':
                 op.status_op = 'pausado'
+            
+            resposta = {
+                'success': True,
+                'message': 'Parada registrada com sucesso!',
+                'redirect': '/'
+            }
+            store_idempotent_response(chave, 'parada', resposta, usuario_id)
+            return resposta
         
-        db.session.commit()
+        resposta = executar_gravacao(gravar)
         
-        session.pop('maquina_id', None)
-        session.pop('op_id', None)
+        # Parada enviada depois, de outra tela: só encerra a sessão se for da máquina atual
+        if resposta.get('success') and session.get('maquina_id') == maquina_id:
+            session.pop('maquina_id', None)
+            session.pop('op_id', None)
         
-        return jsonify({
-            'success': True,
-            'message': 'Parada registrada com sucesso!',
-            'redirect': '/'
-        })
+        return jsonify(resposta)
+    
+    except IntegrityError:
+        db.session.rollback()
+        anterior = find_idempotent_response(chave, 'parada') if chave else None
+        if anterior is not None:
+            return jsonify(dict(anterior, duplicado=True) if anterior.get('success') else anterior)
+        return jsonify({'success': False, 'message': 'Erro: parada em conflito'})
         
     except Exception as e:
         db.session.rollback()
@@ -834,15 +2841,7 @@ def admin_dashboard():
         db.func.date(Apontamento.data_hora_inicio) == hoje
     ).scalar() or 0
     
-    # Contar usuários para o dashboard
-    usuarios_com_qr = []
-    usuarios = Usuario.query.all()
-    for usuario in usuarios:
-        qr_data = generate_qr_code(usuario.codigo_qr)
-        usuarios_com_qr.append({
-            'usuario': usuario,
-            'qr_code': qr_data
-        })
+    total_usuarios = Usuario.query.count()
     
     # Última sincronização bem-sucedida
     last_sync = LogSincronizacao.query.filter_by(
@@ -859,7 +2858,7 @@ def admin_dashboard():
                          producao_hoje=producao_hoje,
                          ultimos_apontamentos=ultimos_apontamentos,
                          maquinas=maquinas,
-                         usuarios_com_qr=usuarios_com_qr,
+                         total_usuarios=total_usuarios,
                          last_sync=last_sync)
 
 @app.route('/admin/setup')
@@ -886,12 +2885,13 @@ def admin_maquinas_page():
     
     maquinas = Maquina.query.order_by(Maquina.setor, Maquina.nome).all()
     
+    # As imagens dos QR Codes são carregadas sob demanda pelo navegador
+    formato = qr_formato_solicitado()
     maquinas_com_qr = []
     for maquina in maquinas:
-        qr_data = generate_qr_code(maquina.codigo_qr)
         maquinas_com_qr.append({
             'maquina': maquina,
-            'qr_code': qr_data
+            'qr_url': url_for('qr_image', versao=QR_PAYLOAD_VERSAO, kind='maquina', code=maquina.codigo_qr, fmt=formato)
         })
     
     return render_template('admin_maquinas.html', maquinas_com_qr=maquinas_com_qr)
@@ -904,12 +2904,13 @@ def admin_usuarios_page():
     
     usuarios = Usuario.query.order_by(Usuario.nome).all()
     
+    # As imagens dos QR Codes são carregadas sob demanda pelo navegador
+    formato = qr_formato_solicitado()
     usuarios_com_qr = []
     for usuario in usuarios:
-        qr_data = generate_qr_code(usuario.codigo_qr)
         usuarios_com_qr.append({
             'usuario': usuario,
-            'qr_code': qr_data
+            'qr_url': url_for('qr_image', versao=QR_PAYLOAD_VERSAO, kind='usuario', code=usuario.codigo_qr, fmt=formato)
         })
     
     return render_template('admin_usuarios.html', usuarios_com_qr=usuarios_com_qr)
@@ -1268,6 +3269,7 @@ def admin_add_maquina():
         
         db.session.add(nova_maquina)
         db.session.commit()
+        qr_resolver.invalidate()
         
         return jsonify({'success': True, 'message': 'Máquina adicionada com sucesso!'})
         
@@ -1294,6 +3296,7 @@ def admin_add_usuario():
         
         db.session.add(novo_usuario)
         db.session.commit()
+        qr_resolver.invalidate()
         
         return jsonify({'success': True, 'message': 'Usuário adicionada com sucesso!'})
         
@@ -1336,22 +3339,90 @@ def generate_qr():
     if not text:
         return jsonify({'error': 'Texto necessário'}), 400
     
-    qr_code = generate_qr_code(text)
+    # Com ?tipo=usuario|maquina|op o preview mostra o mesmo conteúdo do crachá impresso
+    if request.args.get('tipo') in QR_PREFIXO_POR_TIPO:
+        text = qr_payload(request.args['tipo'], text)
+    
+    try:
+        qr_code = generate_qr_code(text, formato=qr_formato_solicitado())
+    except ValueError:
+        return jsonify({'error': 'Texto longo demais para um QR Code'}), 400
     return jsonify({'qr_code': qr_code})
 
+QR_FORMATOS = {
+    'png': render_qr_png,
+    'svg': render_qr_svg,
+}
+
+def qr_formato_solicitado(padrao='png'):
+    """Formato de QR pedido na query string (?formato=png|svg)"""
+    formato = request.args.get('formato', padrao)
+    return formato if formato in QR_FORMATOS else padrao
+
+def qr_image_response(text, fmt='png'):
+    """Monta a resposta binária do QR Code com ETag forte e cache imutável"""
+    try:
+        data = QR_FORMATOS[fmt](text)
+    except ValueError:
+        # Texto além da capacidade da maior versão do QR Code
+        abort(400)
+    
+    response = make_response(data)
+    response.headers.set('Content-Type', QR_MIMETYPES[fmt])
+    # O conteúdo de uma URL nunca muda: o texto do QR faz parte do caminho. Crachás
+    # valem como login, então a imagem fica só no navegador de quem está logado
+    response.headers.set('Cache-Control', 'private, max-age=31536000, immutable')
+    response.set_etag(hashlib.sha1(data).hexdigest())
+    return response.make_conditional(request)
+
+@app.route('/qr/v<int:versao>/<kind>/<path:code>.svg', defaults={'fmt': 'svg'})
+@app.route('/qr/v<int:versao>/<kind>/<path:code>.png', defaults={'fmt': 'png'})
+def qr_image(versao, kind, code, fmt):
+    """Serve o QR Code como imagem para carregamento sob demanda"""
+    if 'usuario_id' not in session:
+        abort(403)
+    if kind not in QR_PREFIXO_POR_TIPO:
+        abort(404)
+    
+    # Página antiga pedindo outra versão do conteúdo: aponta para a atual
+    if versao != QR_PAYLOAD_VERSAO:
+        return redirect(url_for('qr_image', versao=QR_PAYLOAD_VERSAO, kind=kind, code=code, fmt=fmt))
+    
+    return qr_image_response(qr_payload(kind, code), fmt)
+
+@app.route('/api/admin/qr_cache')
+def get_qr_cache_stats():
+    """Retorna os contadores do cache de QR Codes"""
+    if session.get('usuario_tipo') != 'admin':
+        return jsonify({'success': False, 'message': 'Não autorizado'})
+    
+    return jsonify({'success': True, 'cache': qr_cache.stats()})
+
+@app.route('/api/admin/group_commit')
+def get_group_commit_stats():
+    """Retorna os contadores da gravação em grupo (desligada: enabled=False)"""
+    if session.get('usuario_tipo') != 'admin':
+        return jsonify({'success': False, 'message': 'Não autorizado'})
+    
+    if group_commit is None:
+        return jsonify({'success': True, 'enabled': False})
+    return jsonify({'success': True, 'enabled': True, 'group_commit': group_commit.stats()})
+
+@app.route('/api/admin/qr_resolver')
+def get_qr_resolver_stats():
+    """Retorna o tamanho do índice de QR Codes e a latência das leituras"""
+    if session.get('usuario_tipo') != 'admin':
+        return jsonify({'success': False, 'message': 'Não autorizado'})
+    
+    return jsonify({'success': True, 'resolver': qr_resolver.stats()})
+
 @app.route('/api/generate_op_qr/<int:op_number>')
 def generate_op_qr(op_number):
-    """Gera QR Code para uma OP específica"""
-    qr_code = generate_qr_code(f"OP{op_number}")
-    # Converter base64 para imagem
-    import base64
-    qr_data = qr_code.split(',')[1]
-    qr_bytes = base64.b64decode(qr_data)
-    
-    from flask import make_response
-    response = make_response(qr_bytes)
-    response.headers.set('Content-Type', 'image/png')
+    """Gera QR Code para uma OP específica (mantido por compatibilidade; as telas usam /qr/v<versão>/op/<n>.png)"""
+    response = qr_image_response(qr_payload('op', op_number))
     response.headers.set('Content-Disposition', 'inline', filename=f'op_{op_number}_qr.png')
+    # URL sem versão do conteúdo: revalida pelo ETag em vez de ficar fixa no navegador
+    response.headers.set('Cache-Control', 'private, no-cache')
     return response
 
 # ========== API SYNC ROUTES ==========
@@ -1363,10 +3434,21 @@ def sync_ops():
         return jsonify({'success': False, 'message': 'Não autorizado'})
     
     try:
-        client = SystextilAPIClient()
-        result = client.sync_orders_to_database()
+        job, iniciado = start_sync_job(origem='manual')
+        
+        if not job:
+            return jsonify({
+                'success': True,
+                'job_id': None,
+                'message': 'Já existe uma sincronização em andamento'
+            })
         
-        return jsonify(result)
+        return jsonify({
+            'success': True,
+            'job_id': job.id,
+            'status': job.status,
+            'message': 'Sincronização iniciada' if iniciado else 'Já existe uma sincronização em andamento'
+        })
         
     except Exception as e:
         return jsonify({
@@ -1374,6 +3456,61 @@ def sync_ops():
             'message': f'Erro na sincronização: {str(e)}'
         })
 
+@app.route('/api/sync/jobs/<int:job_id>')
+def get_sync_job(job_id):
+    """Retorna o status de um job de sincronização"""
+    if session.get('usuario_tipo') != 'admin':
+        return jsonify({'success': False, 'message': 'Não autorizado'})
+    
+    job = db.session.get(JobSincronizacao, job_id)
+    if not job:
+        return jsonify({'success': False, 'message': 'Job não encontrado'})
+    
+    return jsonify({'success': True, 'job': serialize_job(job)})
+
+@app.route('/api/sync/stream/<int:job_id>')
+def sync_stream(job_id):
+    """Stream SSE com o progresso de um job de sincronização.
+    
+    Cada conexão dura no máximo SYNC_STREAM_MAX_SECONDS; o EventSource do navegador
+    reconecta sozinho, então nenhuma requisição fica aberta durante toda a sincronização.
+    """
+    if session.get('usuario_tipo') != 'admin':
+        return jsonify({'success': False, 'message': 'Não autorizado'})
+    
+    def eventos():
+        yield "retry: 1000\n\n"
+        
+        ultimo = None
+        limite = time.monotonic() + SYNC_STREAM_MAX_SECONDS
+        
+        while time.monotonic() < limite:
+            job = db.session.get(JobSincronizacao, job_id, populate_existing=True)
+            if not job:
+                yield f"event: erro\ndata: {json.dumps({'message': 'Job não encontrado'})}\n\n"
+                return
+            
+            dados = json.dumps(serialize_job(job))
+            finalizado = job.status in ('sucesso', 'erro')
+            
+            # Encerra a transação de leitura para enxergar a próxima atualização do job
+            db.session.rollback()
+            
+            if dados != ultimo:
+                yield f"event: progresso\ndata: {dados}\n\n"
+                ultimo = dados
+            
+            if finalizado:
+                yield f"event: fim\ndata: {dados}\n\n"
+                return
+            
+            time.sleep(0.5)
+    
+    return Response(stream_with_context(eventos()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/api/sync/test_connection', methods=['GET'])
 def test_api_connection():
     """Testa conexão com API externa"""
@@ -1381,8 +3518,10 @@ def test_api_connection():
         return jsonify({'success': False, 'message': 'Não autorizado'})
     
     try:
-        client = SystextilAPIClient()
-        token_result = client._get_access_token()
+        client = get_api_client()
+        # Busca um token novo em vez de aceitar o do cache: o teste precisa ir até o ERP
+        with client._token_lock:
+            token_result = client._get_access_token()
         
         if token_result:
             return jsonify({
@@ -1419,6 +3558,7 @@ def get_sync_logs():
             'registros_processados': log.registros_processados,
             'registros_novos': log.registros_novos,
             'registros_atualizados': log.registros_atualizados,
+            'registros_inalterados': log.registros_inalterados,
             'duracao_segundos': log.duracao_segundos,
             'status': log.status,
             'mensagem': log.mensagem,
@@ -1437,141 +3577,142 @@ def print_op(op_id):
     if not op:
         return "OP não encontrada", 404
     
-    # Gerar QR Code
-    qr_code = generate_qr_code(f"OP{op.op}")
-    
-    return f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>OP {op.op} - Impressão</title>
-        <style>
-            body {{
-                font-family: Arial, sans-serif;
-                padding: 20px;
-                max-width: 800px;
-                margin: 0 auto;
-            }}
-            .print-header {{
-                text-align: center;
-                margin-bottom: 30px;
-                border-bottom: 2px solid #333;
-                padding-bottom: 20px;
-            }}
-            .company-info {{
-                margin-bottom: 20px;
-            }}
-            .op-info {{
-                display: grid;
-                grid-template-columns: 1fr 1fr;
-                gap: 20px;
-                margin-bottom: 30px;
-            }}
-            .info-box {{
-                border: 1px solid #ddd;
-                padding: 15px;
-                border-radius: 5px;
-            }}
-            .qr-container {{
-                text-align: center;
-                margin: 20px 0;
-            }}
-            .status-badge {{
-                display: inline-block;
-                padding: 5px 15px;
-                border-radius: 20px;
-                font-weight: bold;
-                margin-top: 10px;
-            }}
-            .status-pendente {{ background: #fff3cd; color: #856404; }}
-            .status-em_andamento {{ background: #d1ecf1; color: #0c5460; }}
-            .status-finalizada {{ background: #d4edda; color: #155724; }}
-            .status-pausado {{ background: #f8d7da; color: #721c24; }}
-            
-            @media print {{
-                body {{ padding: 0; }}
-                .no-print {{ display: none; }}
-                .print-header {{ border-bottom: 2px solid #000; }}
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="print-header">
-            <div class="company-info">
-                <h1>LEAN PRODUCTION SYSTEM</h1>
-                <h2>ORDEM DE PRODUÇÃO</h2>
-            </div>
-            
-            <div class="qr-container">
-                <img src="{qr_code}" alt="QR Code OP {op.op}" width="150">
-                <h3>OP {op.op}</h3>
-            </div>
-            
-            <div class="status-badge status-{op.status_op}">
-                {op.status_op.upper()}
-            </div>
-        </div>
-        
-        <div class="op-info">
-            <div class="info-box">
-                <h4>Informações da OP</h4>
-                <p><strong>Produto:</strong> {op.produto}</p>
-                <p><strong>Descrição:</strong> {op.narrativa}</p>
-                <p><strong>Grupo:</strong> {op.grupo or 'N/A'}</p>
-                <p><strong>Unidade:</strong> {op.unidade_medida}</p>
-            </div>
-            
-            <div class="info-box">
-                <h4>Quantidades</h4>
-                <p><strong>Programado:</strong> {op.qtde_programado} {op.unidade_medida}</p>
-                <p><strong>Carregado:</strong> {op.qtde_carregado} {op.unidade_medida}</p>
-                <p><strong>Produzido:</strong> {op.qtde_produzida} {op.unidade_medida}</p>
-                <p><strong>Disponível:</strong> {op.qtde_carregado - op.qtde_produzida} {op.unidade_medida}</p>
-            </div>
-        </div>
-        
-        <div class="op-info">
-            <div class="info-box">
-                <h4>Status e Localização</h4>
-                <p><strong>Estágio Atual:</strong> {op.estagio_atual or 'N/A'}</p>
-                <p><strong>Posição:</strong> {op.estagio_posicao or 'N/A'}</p>
-                <p><strong>Data Início:</strong> {op.data_inicio.strftime('%d/%m/%Y') if op.data_inicio else 'N/A'}</p>
-                <p><strong>Data Término:</strong> {op.data_termino.strftime('%d/%m/%Y') if op.data_termino else 'N/A'}</p>
-            </div>
-            
-            <div class="info-box">
-                <h4>Informações Técnicas</h4>
-                <p><strong>Código QR:</strong> OP{op.op}</p>
-                <p><strong>ID no Sistema:</strong> {op.id}</p>
-                <p><strong>Data de Criação:</strong> {op.data_importacao.strftime('%d/%m/%Y') if op.data_importacao else 'N/A'}</p>
-                <p><strong>Última Atualização:</strong> {datetime.utcnow().strftime('%d/%m/%Y %H:%M')}</p>
-            </div>
-        </div>
-        
-        <div class="no-print" style="margin-top: 40px; text-align: center;">
-            <button onclick="window.print()" style="padding: 10px 20px; font-size: 16px;">
-                🖨️ Imprimir
-            </button>
-            <button onclick="window.close()" style="padding: 10px 20px; font-size: 16px; margin-left: 10px;">
-                ❌ Fechar
-            </button>
-        </div>
-        
-        <script>
-            window.onload = function() {{
-                // Auto-print em alguns casos
-                const urlParams = new URLSearchParams(window.location.search);
-                if (urlParams.get('auto') === 'true') {{
-                    window.print();
-                    setTimeout(function() {{
-                        window.close();
-                    }}, 1000);
-                }}
-            }};
-        </script>
-    </body>
-    </html>
+    # Gerar QR Code (vetorial por padrão, para impressão nítida)
+    qr_code = generate_qr_code(qr_payload('op', op.op), formato=qr_formato_solicitado('svg'))
+    
+    return render_template('op_print.html',
+                         titulo=f"OP {op.op}",
+                         ops=[{'op': op, 'qr_code': qr_code}],
+                         agora=datetime.utcnow())
+
+OPS_PRINT_LOTE = 200
+
+def filtrar_ops_impressao(query, args):
+    """Aplica os filtros de impressão (ids, status, since) a uma query de OPs.
+    
+    Levanta ValueError se `since` não for uma data válida.
     """
+    ids = [int(i) for i in args.get('ids', '').split(',') if i.strip().isdigit()]
+    if ids:
+        query = query.filter(OrdemProducao.id.in_(ids))
+    if args.get('status'):
+        query = query.filter_by(status_op=args['status'])
+    if args.get('since'):
+        query = query.filter(OrdemProducao.data_importacao >= datetime.fromisoformat(args['since']))
+    return query
+
+def iter_ops_impressao(query, formato):
+    """Percorre as OPs em lotes, gerando os QR Codes de cada lote de uma vez"""
+    for lote in iter_chunks(query.yield_per(OPS_PRINT_LOTE), OPS_PRINT_LOTE):
+        imagens = render_qr_lote([qr_payload('op', op.op) for op in lote], formato)
+        for op in lote:
+            yield {'op': op, 'qr_code': qr_data_url(imagens[qr_payload('op', op.op)], formato)}
+
+@app.route('/admin/ops/print')
+def print_ops():
+    """Impressão em lote das fichas de OP (ex.: ?status=pendente&since=2024-01-01).
+    
+    O documento é enviado aos poucos enquanto as OPs são lidas, para que a impressão
+    do início do turno não estoure o tempo limite da requisição.
+    """
+    if session.get('usuario_tipo') != 'admin':
+        return redirect('/')
+    
+    try:
+        query = filtrar_ops_impressao(OrdemProducao.query, request.args)
+    except ValueError:
+        return "Data inválida em 'since' (use AAAA-MM-DD)", 400
+    
+    contexto = {
+        'titulo': 'Fichas de OP',
+        'ops': iter_ops_impressao(query.order_by(OrdemProducao.op), qr_formato_solicitado('svg')),
+        'agora': datetime.utcnow()
+    }
+    app.update_template_context(contexto)
+    
+    stream = app.jinja_env.get_template('op_print.html').stream(contexto)
+    stream.enable_buffering(10)
+    return Response(stream_with_context(stream), mimetype='text/html')
+
+ETIQUETAS_MAX = int(os.getenv('ETIQUETAS_MAX', 2000))
+
+@app.route('/admin/etiquetas/<kind>')
+def print_etiquetas(kind):
+    """Folha de etiquetas para impressão em lote (usuários, máquinas ou OPs).
+    
+    Filtros opcionais na query string: ids (lista separada por vírgula), setor, tipo,
+    ativo, status e since (data de importação mínima das OPs, AAAA-MM-DD).
+    """
+    if session.get('usuario_tipo') != 'admin':
+        return redirect('/')
+    
+    args = request.args
+    ids = [int(i) for i in args.get('ids', '').split(',') if i.strip().isdigit()]
+    
+    if kind == 'usuario':
+        query = Usuario.query
+        if ids:
+            query = query.filter(Usuario.id.in_(ids))
+        if args.get('setor'):
+            query = query.filter_by(setor=args['setor'])
+        if args.get('tipo'):
+            query = query.filter_by(tipo=args['tipo'])
+        if args.get('ativo', '1') != 'todos':
+            query = query.filter_by(ativo=args.get('ativo', '1') == '1')
+        registros = query.order_by(Usuario.nome).limit(ETIQUETAS_MAX).all()
+        etiquetas = [{
+            'texto': qr_payload('usuario', u.codigo_qr),
+            'codigo': u.codigo_qr,
+            'titulo': u.nome,
+            'linhas': [u.tipo.upper(), u.setor or '']
+        } for u in registros]
+        titulo = 'Crachás de Usuários'
+    
+    elif kind == 'maquina':
+        query = Maquina.query
+        if ids:
+            query = query.filter(Maquina.id.in_(ids))
+        if args.get('setor'):
+            query = query.filter_by(setor=args['setor'])
+        if args.get('tipo'):
+            query = query.filter_by(tipo_maquina=args['tipo'])
+        if args.get('status'):
+            query = query.filter_by(status=args['status'])
+        registros = query.order_by(Maquina.setor, Maquina.nome).limit(ETIQUETAS_MAX).all()
+        etiquetas = [{
+            'texto': qr_payload('maquina', m.codigo_qr),
+            'codigo': m.codigo_qr,
+            'titulo': m.nome,
+            'linhas': [m.codigo, m.setor.upper()]
+        } for m in registros]
+        titulo = 'Placas de Máquinas'
+    
+    elif kind == 'op':
+        try:
+            query = filtrar_ops_impressao(OrdemProducao.query, args)
+        except ValueError:
+            return "Data inválida em 'since' (use AAAA-MM-DD)", 400
+        registros = query.order_by(OrdemProducao.op).limit(ETIQUETAS_MAX).all()
+        etiquetas = [{
+            'texto': qr_payload('op', op.op),
+            'codigo': f"OP{op.op}",
+            'titulo': f"OP {op.op}",
+            'linhas': [op.produto, f"{op.qtde_carregado} {op.unidade_medida}"]
+        } for op in registros]
+        titulo = 'Etiquetas de OPs'
+    
+    else:
+        return "Tipo de etiqueta inválido", 404
+    
+    formato = qr_formato_solicitado('svg')
+    imagens = render_qr_lote([e['texto'] for e in etiquetas], formato)
+    for etiqueta in etiquetas:
+        etiqueta['qr_code'] = qr_data_url(imagens[etiqueta['texto']], formato)
+    
+    return render_template('etiquetas.html',
+                         titulo=titulo,
+                         etiquetas=etiquetas,
+                         limite_atingido=len(etiquetas) >= ETIQUETAS_MAX)
 
 # ========== INICIALIZAÇÃO ==========
 
@@ -1588,6 +3729,10 @@ def create_ssl_context():
 if __name__ == '__main__':
     init_database()
     
+    # Com o reloader do modo debug, apenas o processo filho (que serve as requisições) agenda
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_sync_scheduler()
+    
     # Verificar se deve usar SSL
     use_ssl = '--ssl' in sys.argv
     ssl_context = None
@@ -1,7 +1,9 @@
-from app import app, db
+from app import app, db, atualizar_esquema
 from datetime import datetime
 
 with app.app_context():
     # Criar todas as tabelas
     db.create_all()
+    # Colunas e índices novos em tabelas que já existiam
+    atualizar_esquema()
     print("Tabelas criadas com sucesso!")
\ No newline at end of file
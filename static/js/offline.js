@@ -0,0 +1,268 @@
+// offline.js - Fila local de apontamentos e paradas das telas do operador
+//
+// Todo registro vai primeiro para o IndexedDB do aparelho, já com a sua chave de
+// idempotência, e depois é enviado ao servidor. Sem rede ele fica guardado e é enviado
+// quando a conexão volta: apontamentos num único POST em /api/apontamentos/batch,
+// paradas uma a uma. Como a chave acompanha o registro, reenviar o que o servidor já
+// gravou (resposta perdida, duas abas abertas) não duplica nada. Cada registro leva o
+// usuario_id de quem o fez e só é enviado enquanto esse operador estiver logado: num
+// tablet compartilhado, a produção do turno anterior espera o dono entrar de novo.
+// A última sessão vista pelo aparelho fica no localStorage, para a tela de produção
+// conferir o seu contexto mesmo sem rede (ela pode ser uma cópia antiga do cache).
+
+const FilaOffline = (function() {
+    const BANCO = 'lean-operador';
+    const TABELA = 'fila';
+    const LOTE_MAXIMO = 500;
+    const INTERVALO_SINCRONIZACAO_MS = 30000;
+    const CHAVE_SESSAO = 'lean-operador-sessao';
+
+    let bancoAberto = null;
+    let cadeia = Promise.resolve();
+
+    function novaChave() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2, 12);
+    }
+
+    function abrirBanco() {
+        if (!bancoAberto) {
+            bancoAberto = new Promise((resolve, reject) => {
+                const pedido = indexedDB.open(BANCO, 1);
+                pedido.onupgradeneeded = () => {
+                    pedido.result.createObjectStore(TABELA, { keyPath: 'chave' });
+                };
+                pedido.onsuccess = () => resolve(pedido.result);
+                pedido.onerror = () => reject(pedido.error);
+            });
+        }
+        return bancoAberto;
+    }
+
+    async function transacao(modo, operacao) {
+        const banco = await abrirBanco();
+        return new Promise((resolve, reject) => {
+            const tx = banco.transaction(TABELA, modo);
+            const resultado = operacao(tx.objectStore(TABELA));
+            tx.oncomplete = () => resolve(resultado && resultado.result);
+            tx.onerror = () => reject(tx.error);
+        });
+    }
+
+    async function enfileirar(tipo, dados) {
+        const registro = {
+            chave: dados.chave_idempotencia || novaChave(),
+            tipo: tipo,
+            criado_em: new Date().toISOString(),
+            erro: null
+        };
+        registro.dados = { ...dados, chave_idempotencia: registro.chave };
+        await transacao('readwrite', tabela => tabela.put(registro));
+        atualizarIndicador();
+        return registro;
+    }
+
+    async function listar() {
+        const registros = await transacao('readonly', tabela => tabela.getAll());
+        return registros.sort((a, b) => a.criado_em.localeCompare(b.criado_em));
+    }
+
+    async function pendentes(tipo) {
+        return (await listar()).filter(r => !r.erro && (!tipo || r.tipo === tipo));
+    }
+
+    async function descartar(chave) {
+        await transacao('readwrite', tabela => tabela.delete(chave));
+        atualizarIndicador();
+    }
+
+    async function marcarRecusado(registro, mensagem) {
+        // Recusado pelo servidor (OP inexistente, dados inválidos): não é reenviado, mas
+        // fica no aparelho para o supervisor conferir
+        registro.erro = mensagem || 'Recusado pelo servidor';
+        await transacao('readwrite', tabela => tabela.put(registro));
+    }
+
+    async function atualizarSessao() {
+        const sessao = await (await fetch('/api/sessao', { cache: 'no-store' })).json();
+        try {
+            localStorage.setItem(CHAVE_SESSAO, JSON.stringify(sessao));
+        } catch (error) {
+            console.warn('Sessão não guardada no aparelho', error);
+        }
+        return sessao;
+    }
+
+    async function conferirContexto(contexto) {
+        // A sessão do servidor ou, sem rede, a última vista pelo aparelho precisa ser a
+        // da tela: uma cópia antiga não enfileira registros de outra OP ou outro operador
+        let sessao = null;
+        try {
+            sessao = await atualizarSessao();
+        } catch (error) {
+            try {
+                sessao = JSON.parse(localStorage.getItem(CHAVE_SESSAO));
+            } catch (erroLeitura) {
+                sessao = null;
+            }
+        }
+        if (!sessao) {
+            return true;  // aparelho nunca falou com o servidor: nada a comparar
+        }
+        return ['usuario_id', 'maquina_id', 'op_id'].every(campo => sessao[campo] === contexto[campo]);
+    }
+
+    async function enviarApontamentos(registros, resultados) {
+        for (let inicio = 0; inicio < registros.length; inicio += LOTE_MAXIMO) {
+            const lote = registros.slice(inicio, inicio + LOTE_MAXIMO);
+            const response = await fetch('/api/apontamentos/batch', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ apontamentos: lote.map(r => r.dados) })
+            });
+            if (response.status === 409) {
+                return false;  // conflito com outro envio: tenta de novo na próxima rodada
+            }
+
+            const result = await response.json();
+            if (!result.resultados) {
+                return false;  // sessão expirada: espera o operador entrar de novo
+            }
+
+            for (const item of result.resultados) {
+                const registro = lote[item.indice];
+                if (item.retentar) {
+                    continue;  // recusa ligada à sessão: continua pendente
+                }
+                resultados[registro.chave] = item;
+                if (item.success) {
+                    await descartar(registro.chave);
+                } else {
+                    await marcarRecusado(registro, item.message);
+                }
+            }
+        }
+        return true;
+    }
+
+    async function enviarParadas(registros, resultados) {
+        for (const registro of registros) {
+            const response = await fetch('/api/registrar_parada', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Idempotency-Key': registro.chave
+                },
+                body: JSON.stringify(registro.dados)
+            });
+            const result = await response.json();
+            if (!result.success && result.retentar) {
+                continue;
+            }
+
+            resultados[registro.chave] = result;
+            if (result.success) {
+                await descartar(registro.chave);
+            } else {
+                await marcarRecusado(registro, result.message);
+            }
+        }
+        return true;
+    }
+
+    async function enviarFila() {
+        const resultados = {};
+        if (!navigator.onLine) {
+            return resultados;
+        }
+
+        // Apontamentos antes das paradas: a parada encerra a sessão da máquina
+        try {
+            const sessao = await atualizarSessao();
+            if (!sessao.usuario_id) {
+                return resultados;  // ninguém logado: espera o próximo login
+            }
+            const fila = (await pendentes()).filter(
+                r => r.dados.usuario_id == null || r.dados.usuario_id === sessao.usuario_id
+            );
+            const ok = await enviarApontamentos(fila.filter(r => r.tipo === 'apontamento'), resultados);
+            if (ok) {
+                await enviarParadas(fila.filter(r => r.tipo === 'parada'), resultados);
+            }
+        } catch (error) {
+            // Rede caiu no meio do envio: o que não foi confirmado continua na fila
+            console.warn('Fila offline: envio interrompido', error);
+        }
+
+        atualizarIndicador();
+        return resultados;
+    }
+
+    function sincronizar() {
+        // Um envio por vez; chamadas seguidas esperam o anterior e reenviam o que sobrou.
+        // Devolve {chave: resultado} dos registros que o servidor respondeu
+        const execucao = cadeia.then(enviarFila);
+        cadeia = execucao.catch(() => null);
+        return execucao;
+    }
+
+    async function atualizarIndicador() {
+        let indicador = document.getElementById('fila-offline');
+        if (!indicador) {
+            indicador = document.createElement('div');
+            indicador.id = 'fila-offline';
+            indicador.className = 'offline-status hidden';
+            document.body.appendChild(indicador);
+        }
+
+        let registros = [];
+        try {
+            registros = await listar();
+        } catch (error) {
+            console.warn('Fila offline indisponível', error);
+        }
+        const aguardando = registros.filter(r => !r.erro).length;
+        const recusados = registros.length - aguardando;
+
+        const partes = [];
+        if (!navigator.onLine) {
+            partes.push('<i class="fas fa-wifi"></i> Sem conexão');
+        }
+        if (aguardando) {
+            partes.push(`${aguardando} registro(s) aguardando envio`);
+        }
+        if (recusados) {
+            partes.push(`${recusados} recusado(s) pelo servidor`);
+        }
+
+        indicador.innerHTML = partes.join(' • ');
+        indicador.classList.toggle('hidden', partes.length === 0);
+        indicador.classList.toggle('erro', recusados > 0);
+    }
+
+    function iniciar() {
+        if ('serviceWorker' in navigator) {
+            navigator.serviceWorker.register('/sw.js', { scope: '/' }).catch(error => {
+                console.warn('Service worker não registrado', error);
+            });
+        }
+        if (!window.indexedDB) {
+            return;
+        }
+
+        window.addEventListener('online', () => sincronizar());
+        window.addEventListener('offline', () => atualizarIndicador());
+        setInterval(() => sincronizar(), INTERVALO_SINCRONIZACAO_MS);
+        sincronizar();
+    }
+
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', iniciar);
+    } else {
+        iniciar();
+    }
+
+    return { novaChave, enfileirar, pendentes, descartar, sincronizar, atualizarSessao, conferirContexto };
+})();
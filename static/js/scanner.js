@@ -123,7 +123,9 @@ async function validateQRCode(qrCode) {
         }
     } catch (error) {
         const statusElement = document.getElementById('status-message');
-        statusElement.innerHTML = `<i class="fas fa-exclamation-triangle"></i> Erro de conexão`;
+        statusElement.innerHTML = navigator.onLine
+            ? `<i class="fas fa-exclamation-triangle"></i> Erro de conexão`
+            : `<i class="fas fa-wifi"></i> Sem conexão: a leitura precisa da rede, tente quando ela voltar`;
         statusElement.style.color = '#dc3545';
         
         setTimeout(() => {
@@ -0,0 +1,94 @@
+// sw.js - Service worker das telas do operador
+//
+// Mantém as telas de chão de fábrica abertas quando a rede cai: páginas do operador
+// vêm da rede e, sem conexão, da última cópia guardada; arquivos estáticos e a lista de
+// motivos de parada saem do cache e são atualizados em segundo plano (os arquivos de
+// /static/ não têm hash no nome, então uma versão nova chega já na visita seguinte).
+// Requisições POST não passam por aqui: a fila de envio fica em offline.js (IndexedDB).
+
+const CACHE_VERSAO = 'lean-operador-v1';
+
+const ARQUIVOS_BASE = [
+    '/',
+    '/static/css/style.css',
+    '/static/js/scanner.js',
+    '/static/js/offline.js',
+    'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css',
+    'https://unpkg.com/html5-qrcode'
+];
+
+// Telas do operador guardadas para uso sem rede (as do admin sempre vão à rede)
+const PAGINAS_OPERADOR = ['/', '/scanner', '/scanner_maquina', '/selecionar_op', '/production'];
+
+const DADOS_EM_CACHE = ['/api/get_motivos_parada'];
+
+self.addEventListener('install', event => {
+    event.waitUntil(
+        caches.open(CACHE_VERSAO).then(cache =>
+            // Um CDN fora do ar não impede a instalação
+            Promise.all(ARQUIVOS_BASE.map(url => cache.add(url).catch(() => null)))
+        ).then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys().then(nomes => Promise.all(
+            nomes.filter(nome => nome !== CACHE_VERSAO).map(nome => caches.delete(nome))
+        )).then(() => self.clients.claim())
+    );
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') {
+        return;
+    }
+
+    const url = new URL(request.url);
+    const mesmaOrigem = url.origin === self.location.origin;
+
+    if (mesmaOrigem && request.mode === 'navigate' && PAGINAS_OPERADOR.includes(url.pathname)) {
+        event.respondWith(redePrimeiro(request, url.pathname));
+    } else if (mesmaOrigem && DADOS_EM_CACHE.includes(url.pathname)) {
+        event.respondWith(cacheAtualizandoEmSegundoPlano(event));
+    } else if ((mesmaOrigem && url.pathname.startsWith('/static/')) || ARQUIVOS_BASE.includes(request.url)) {
+        event.respondWith(cacheAtualizandoEmSegundoPlano(event));
+    }
+});
+
+async function guardar(chave, response) {
+    // Redirecionamentos (sessão expirada) não substituem a cópia boa da tela
+    if (response.ok && !response.redirected) {
+        const cache = await caches.open(CACHE_VERSAO);
+        await cache.put(chave, response.clone());
+    }
+    return response;
+}
+
+async function redePrimeiro(request, chave) {
+    // A tela é guardada pelo caminho, sem a query (?continue=true, ?q=...). A cópia só
+    // entra quando a rede falha de fato: uma resposta lenta ainda é a tela da sessão
+    // atual, e a cópia guardada pode ser de outra OP ou de outro operador
+    try {
+        return await guardar(chave, await fetch(request));
+    } catch (error) {
+        const copia = await caches.match(chave);
+        if (copia) {
+            return copia;
+        }
+        throw error;
+    }
+}
+
+async function cacheAtualizandoEmSegundoPlano(event) {
+    const request = event.request;
+    const copia = await caches.match(request);
+    const atualizacao = fetch(request).then(response => guardar(request, response));
+    if (copia) {
+        // Mantém o service worker vivo até a cópia nova ser gravada
+        event.waitUntil(atualizacao.catch(() => null));
+        return copia;
+    }
+    return atualizacao;
+}
@@ -0,0 +1,24 @@
+# sync_worker.py
+
+"""
+Processo dedicado à sincronização automática de OPs com a API Systêxtil.
+
+Uso: python sync_worker.py  (intervalo em SYNC_INTERVAL_MINUTES, padrão 30)
+"""
+
+import os
+from app import app, db, atualizar_esquema, SyncScheduler
+
+if __name__ == '__main__':
+    intervalo = int(os.getenv('SYNC_INTERVAL_MINUTES', 30))
+    # O worker pode subir antes do app num banco de uma versão anterior
+    with app.app_context():
+        db.create_all()
+        atualizar_esquema()
+    
+    print(f"⏱️  Sincronizando OPs a cada {intervalo} minutos. Ctrl+C para parar.")
+    
+    try:
+        SyncScheduler(intervalo).run()
+    except KeyboardInterrupt:
+        print("\n👋 Encerrando sincronização automática...")